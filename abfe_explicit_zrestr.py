@@ -110,10 +110,13 @@ class openmm_job_AmberABFE_zrestr(openmm_job_ATM):
         #builds service worker for replicas use
         service_ommsys = OMMSystemAmberABFE_zrestr(self.basename, self.keywords, prmtopfile, crdfile, self.logger)
         self.service_worker = OMMWorkerATM(self.basename, service_ommsys, self.keywords, compute = False, logger=self.logger)
+        #the compute workers deserialize the System built by the service worker
+        system_data = service_ommsys.system_data_of()
         #creates openmm replica objects
+        self.replica_store = self._makeReplicaStore()
         self.openmm_replicas = []
         for i in range(self.nreplicas):
-            replica = OMMReplicaATM(i, self.basename, self.service_worker, self.logger)
+            replica = OMMReplicaATM(i, self.basename, self.service_worker, self.logger, store = self.replica_store)
             if replica.stateid == None:
                 replica.set_state(i, self.stateparams[i])#initial setting
             self.openmm_replicas.append(replica)
@@ -122,7 +125,9 @@ class openmm_job_AmberABFE_zrestr(openmm_job_ATM):
         self.openmm_workers = []
         for node in self.compute_nodes:
             ommsys = OMMSystemAmberABFE_zrestr(self.basename, self.keywords, prmtopfile, crdfile, self.logger)
-            self.openmm_workers.append(OMMWorkerATM(self.basename, ommsys, self.keywords, node_info = node, compute=True, logger=self.logger))
+            ommsys.system_data = system_data
+            self.openmm_workers.append(OMMWorkerATM(self.basename, ommsys, self.keywords, node_info = node, compute=True, logger=self.logger, completion_queue=self.completion_queue, start=False))
+        self._startWorkers()
 
 if __name__ == '__main__':
 
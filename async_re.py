@@ -16,10 +16,14 @@ import random, glob
 import shutil
 import logging, logging.config
 import signal
+import numpy as np
 
 from configobj import ConfigObj
 
 from gibbs_sampling import *
+from replica_status import ReplicaStatusTable
+from schedule_control import ScheduleController
+from node_pool import read_nodefile
 
 from ommreplica import *
 from ommworker import *
@@ -44,6 +48,15 @@ class async_re(object):
 
         self._setLogger()
 
+        # queue on which the compute workers notify completed runs, see openmm_job
+        self.completion_queue = None
+        # latest online estimate of the binding free energy and its error, see scheduleJobs()
+        self.dgb_estimate = None
+        self.subjobs_buffer_size = None
+        # background writers of checkpoint and trajectory files, see openmm_job
+        self.checkpoint_writer = None
+        self.trajectory_writer = None
+
         self.command_file = command_file
         if not os.path.exists(self.command_file):
            self._exit('No such file: %s'%self.command_file)
@@ -64,6 +77,7 @@ class async_re(object):
     def _exit(self, message):
         """Print and flush a message to stdout and then exit."""
         self.checkpointJob()
+        self._flushWriters()
         self._cleanup()
         self.logger.info(message)
         sys.stdout.flush()
@@ -76,6 +90,13 @@ class async_re(object):
         sys.exit(1)
 
 
+    def _flushWriters(self):
+        # waits for the last checkpoint and trajectory frames to land on disk and stops the writers
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+        if self.trajectory_writer is not None:
+            self.trajectory_writer.close()
+
     def getVersion(self):
         return __version__
 
@@ -93,36 +114,41 @@ class async_re(object):
     def _setLogger(self):
         self.logger = logging.getLogger("async_re")
 
-    def __getattribute__(self, name):
-        if name == 'replicas_waiting':
-            # Return a list of replica indices of replicas in a wait state.
-            return [k for k in range(self.nreplicas)
-                    if self.status[k]['running_status'] == 'W']
-        elif name == 'states_waiting':
-            # Return a list of state ids of replicas in a wait state.
-            return [self.status[k]['stateid_current']
-                    for k in self.replicas_waiting]
-        elif name == 'replicas_waiting_to_exchange':
-            # Return a list of replica indices of replicas in a wait state that
-            # have ALSO completed at least one cycle.
-            return [k for k in range(self.nreplicas)
-                    if (self.status[k]['running_status'] == 'W' and
-                        self.status[k]['cycle_current'] > 1)]
-        elif name == 'states_waiting_to_exchange':
-            # Return a list of state ids of replicas in a wait state that have
-            # ALSO completed at least one cycle.
-            return [self.status[k]['stateid_current']
-                    for k in self.replicas_waiting_to_exchange]
-        elif name == 'waiting':
-            return len(self.replicas_waiting)
-        elif name == 'replicas_running':
-            # Return a list of replica indices of replicas in a running state.
-            return [k for k in range(self.nreplicas)
-                    if self.status[k]['running_status'] == 'R']
-        elif name == 'running':
-            return len(self.replicas_running)
-        else:
-            return object.__getattribute__(self,name)
+    # views of the status table, kept current by ReplicaStatusTable
+    @property
+    def replicas_waiting(self):
+        # Return a list of replica indices of replicas in a wait state.
+        return self.status.replicas_waiting()
+
+    @property
+    def states_waiting(self):
+        # Return a list of state ids of replicas in a wait state.
+        return self.status.states_of(self.replicas_waiting)
+
+    @property
+    def replicas_waiting_to_exchange(self):
+        # Return a list of replica indices of replicas in a wait state that
+        # have ALSO completed at least one cycle.
+        return self.status.replicas_waiting_to_exchange()
+
+    @property
+    def states_waiting_to_exchange(self):
+        # Return a list of state ids of replicas in a wait state that have
+        # ALSO completed at least one cycle.
+        return self.status.states_of(self.replicas_waiting_to_exchange)
+
+    @property
+    def waiting(self):
+        return len(self.status.waiting)
+
+    @property
+    def replicas_running(self):
+        # Return a list of replica indices of replicas in a running state.
+        return self.status.replicas_running()
+
+    @property
+    def running(self):
+        return len(self.status.running)
 
     def _printStatus(self):
         """Print a report of the input parameters."""
@@ -166,24 +192,9 @@ class async_re(object):
             """
             node_info= []
             try:
-                f = open(nodefile, 'r')
-                line=f.readline()
-                nodeid = 0
-                while line:
-                    lineID=line.split(",")
-                    node_info.append({})
-                    node_info[nodeid]["node_name"] = str(lineID[0].strip())
-                    node_info[nodeid]["slot_number"] = str(lineID[1].strip())
-                    node_info[nodeid]["threads_number"] = str(lineID[2].strip())
-                    node_info[nodeid]["arch"] = str(lineID[3].strip())
-                    node_info[nodeid]["user_name"] = str(lineID[4].strip())
-                    node_info[nodeid]["tmp_folder"] = str(lineID[5].strip())
-                    #tmp_folder has to be pre-assigned
-                    if node_info[nodeid]["tmp_folder"] == "":
-                        self._exit('tmp_folder in nodefile needs to be specified')
-                    nodeid += 1
-                    line = f.readline()
-                f.close()
+                node_info = read_nodefile(nodefile)
+            except ValueError as e:
+                self._exit(str(e))
             except:
                 self._exit("Unable to process nodefile %s" % nodefile)
                 # reset job transport
@@ -218,19 +229,66 @@ class async_re(object):
         else:
             self.verbose = False
 
+        # number of sweeps of pairwise exchanges amongst waiting replicas
+        if self.keywords.get('EXCHANGE_SWEEPS') is None:
+            self.exchange_sweeps = 1
+        else:
+            self.exchange_sweeps = int(self.keywords.get('EXCHANGE_SWEEPS'))
+
+        # flush policy of the replica sample logs
+        if self.keywords.get('SAMPLE_LOG_FLUSH_SAMPLES') is None:
+            self.sample_log_flush_samples = 100
+        else:
+            self.sample_log_flush_samples = int(self.keywords.get('SAMPLE_LOG_FLUSH_SAMPLES'))
+        if self.keywords.get('SAMPLE_LOG_FLUSH_INTERVAL') is None:
+            self.sample_log_flush_interval = 60.0
+        else:
+            self.sample_log_flush_interval = float(self.keywords.get('SAMPLE_LOG_FLUSH_INTERVAL'))
+
+        # A replica that completed a cycle is held in the wait state for up to
+        # EXCHANGE_WINDOW seconds when a replica in a neighboring state is predicted
+        # to complete within that time, so that it can take part in the exchange
+        if self.keywords.get('EXCHANGE_WINDOW') is None:
+            self.exchange_window = None
+        else:
+            self.exchange_window = float(self.keywords.get('EXCHANGE_WINDOW'))
+
+        # launch priorities of replicas, as comma-separated replica:priority pairs.
+        # Replicas with higher priority are launched first, the default is 0
+        self.replica_priority = {}
+        if self.keywords.get('REPLICA_PRIORITIES') is not None:
+            try:
+                for pair in self.keywords.get('REPLICA_PRIORITIES').split(','):
+                    (replica, priority) = pair.split(':')
+                    self.replica_priority[int(replica)] = int(priority)
+            except ValueError:
+                self._exit("REPLICA_PRIORITIES must be a list of replica:priority pairs")
+
         self.implicitsolvent =  self.keywords.get('IMPLICITSOLVENT')
         self.totalsteps = self.keywords.get('PRODUCTION_STEPS')
         self.jobname = self.keywords.get('BASENAME')
         self.stepgap = self.keywords.get('PRNT_FREQUENCY')
 
     def setupJob(self):
-        self.transport = LocalOpenMMTransport(self.basename, self.openmm_workers, self.openmm_replicas)
+        self.transport = LocalOpenMMTransport(self.basename, self.openmm_workers, self.openmm_replicas,
+                                              self.completion_queue)
         # create status table
-        self.status = [{'stateid_current': k, 'running_status': 'W',
-                        'cycle_current': 1} for k in range(self.nreplicas)]
+        self.status = ReplicaStatusTable(self.nreplicas)
+        # time at which each replica last completed a cycle and at which it was
+        # first held for an exchange, see _holdForExchange()
+        self.completion_time = [ None for k in range(self.nreplicas)]
+        self.hold_since = [ None for k in range(self.nreplicas)]
+        # accumulated hold time and sizes of the exchange pools
+        self.hold_time = 0.0
+        self.nholds = 0
+        self.exchange_pool_total = 0
+        self.nexchange_pools = 0
         for replica in self.openmm_replicas:
+            replica.sample_log.set_flush_policy(self.sample_log_flush_samples, self.sample_log_flush_interval)
             self.status[replica._id]['cycle_current'] = replica.get_cycle()
             self.status[replica._id]['stateid_current'] = replica.get_stateid()
+            #a replica restarted in the middle of a cycle shortened in the tail phase
+            self.status.set_midcycle(replica._id, replica.get_mdsteps() % int(self.keywords.get('PRODUCTION_STEPS')) != 0)
             self.logger.info("Replica %d Cycle %d Stateid %d" % (replica._id, self.status[replica._id]['cycle_current'], self.status[replica._id]['stateid_current']))
         self.updateStatus()
 
@@ -276,15 +334,64 @@ class async_re(object):
             if enough_samples:
                 self.logger.info("All replicas collected the requested number of samples (%d)" % max_samples)
 
+        # Online estimation of the binding free energy every DGB_ESTIMATE_TIME
+        # seconds (default: at every checkpoint). The job terminates when its
+        # standard error is below DGB_TARGET_ERROR (kcal/mol) and each replica
+        # has collected at least DGB_MIN_SAMPLES samples
+        target_error = None
+        if self.keywords.get('DGB_TARGET_ERROR') is not None:
+            target_error = float(self.keywords.get('DGB_TARGET_ERROR'))
+        if self.keywords.get('DGB_ESTIMATE_TIME') is None:
+            estimate_time = checkpoint_time
+        else:
+            estimate_time = float(self.keywords.get('DGB_ESTIMATE_TIME'))
+        estimate = target_error is not None or self.keywords.get('DGB_ESTIMATE_TIME') is not None
+        if self.keywords.get('DGB_MIN_SAMPLES') is None:
+            min_samples = 0
+        else:
+            min_samples = int(self.keywords.get('DGB_MIN_SAMPLES'))
+
+        # With ADAPTIVE_SCHEDULING = yes the values above are the initial values
+        # of CYCLE_TIME, MIN_TIME, SUBJOBS_BUFFER_SIZE and of the shutdown margin,
+        # which are then tuned from the measured cycle durations, exchange
+        # latency and device idle time
+        controller = None
+        adaptive = self.keywords.get('ADAPTIVE_SCHEDULING')
+        if adaptive is not None and adaptive.lower() == 'yes':
+            if self.keywords.get('SUBJOBS_BUFFER_SIZE') is None:
+                buffer_size = 0.5
+            else:
+                buffer_size = float(self.keywords.get('SUBJOBS_BUFFER_SIZE'))
+            controller = ScheduleController(cycle_time, min_time, buffer_size, 60*replica_run_time,
+                                            logger = self.logger)
+
+        # With TAIL_SCHEDULING = yes replicas are launched until the end of the
+        # wall time less a reserve for the final checkpoint, TAIL_RESERVE seconds
+        # (default 60) plus twice the measured duration of a checkpoint. The
+        # transport shortens the last launches so that they are predicted to
+        # complete before then.
+        tail = self.keywords.get('TAIL_SCHEDULING') is not None and self.keywords.get('TAIL_SCHEDULING').lower() == 'yes'
+        if self.keywords.get('TAIL_RESERVE') is None:
+            tail_reserve = 60.0
+        else:
+            tail_reserve = float(self.keywords.get('TAIL_RESERVE'))
+        checkpoint_duration = 0.0
+
         start_time = time.time()
         end_time = start_time + 60*(self.walltime - replica_run_time)
+        hard_end_time = start_time + 60*self.walltime
+        if tail:
+            end_time = hard_end_time - tail_reserve
+            self.transport.deadline = end_time
         last_checkpoint_time = start_time
+        last_estimate_time = start_time
 
         while ( time.time() < end_time and
-                self.transport.numNodesAlive() > 0 and
+                self.transport.numNodesAlive() + self._numNodesStarting() > 0 and
                 not enough_samples ) :
             current_time = time.time()
 
+            self._updateNodePool()
             self.updateStatus()
             self.print_status()
             self.launchJobs()
@@ -295,16 +402,54 @@ class async_re(object):
 
             self.updateStatus()
             self.print_status()
+            exchange_start_time = time.time()
             if self.exchange:
                 self.doExchanges()
+            exchange_time = time.time() - exchange_start_time
             self._write_status()
             self.print_status()
 
             if current_time - last_checkpoint_time > checkpoint_time:
                 self.logger.info("Checkpointing ...")
+                checkpoint_start_time = time.time()
                 self.checkpointJob()
                 last_checkpoint_time = current_time
                 self.logger.info("done.")
+                self.transport.logTimings()
+                self._logExchangeStats()
+                self._updateAllocation()
+                checkpoint_time_spent = time.time() - checkpoint_start_time
+                if self.checkpoint_writer is not None:
+                    checkpoint_time_spent += self.checkpoint_writer.write_time
+                checkpoint_duration = max(checkpoint_duration, checkpoint_time_spent)
+                if controller is not None:
+                    controller.add_checkpoint_time(checkpoint_time_spent)
+
+            if controller is not None:
+                controller.update(self.transport.cycleDurations(), exchange_time,
+                                  self.transport.idleTime(), self.transport.numNodesAlive(), time.time())
+                cycle_time = controller.cycle_time
+                min_time = controller.min_time
+                self.subjobs_buffer_size = controller.buffer_size
+                end_time = start_time + 60*self.walltime - controller.margin
+
+            if tail:
+                end_time = hard_end_time - tail_reserve - 2*checkpoint_duration
+                self.transport.deadline = end_time
+                if self.transport.deadline_blocked and self.transport.nodesRunning() == 0:
+                    self.logger.info("No more replicas can complete before the end of the wall time")
+                    break
+
+            if estimate and current_time - last_estimate_time > estimate_time:
+                self.dgb_estimate = self._estimateFreeEnergy()
+                last_estimate_time = current_time
+                if self.dgb_estimate is not None:
+                    (dgb, ddgb) = self.dgb_estimate
+                    self.logger.info("Free energy estimate: %f +- %f kcal/mol" % (dgb, ddgb))
+                    nsamples = min( [ (replica.get_cycle()-1)/cycle_to_sample for replica in self.openmm_replicas ] )
+                    if target_error is not None and ddgb < target_error and nsamples >= min_samples:
+                        self.logger.info("Free energy estimate reached the target error (%f kcal/mol)" % target_error)
+                        break
 
             #terminates if enough samples have been collected
             if self.keywords.get('MAX_SAMPLES')  is not None:
@@ -314,7 +459,7 @@ class async_re(object):
                 if enough_samples:
                     self.logger.info("All replicas collected the requested number of samples (%d)" % max_samples)
 
-        if self.transport.numNodesAlive() <= 0 :
+        if self.transport.numNodesAlive() + self._numNodesStarting() <= 0 :
             self.logger.info("No compute devices are alive. Quitting.")
         else:
             if time.time() >= end_time :
@@ -324,19 +469,26 @@ class async_re(object):
         self.transport.DrainJobQueue()
         self.updateStatus()
         self.print_status()
-        self.waitJob()
+        if tail:
+            #replicas that do not complete in time are checkpointed at their last state
+            self.waitJob(hard_end_time - 0.5*tail_reserve - 2*checkpoint_duration)
+        else:
+            self.waitJob()
+        self.transport.logTimings()
+        self._logExchangeStats()
         self.checkpointJob()
+        self._flushWriters()
         self.cleanJob()
 
-    def waitJob(self):
-        # wait until all jobs are complete
+    def waitJob(self, until = None):
+        # wait until all jobs are complete, or until the given time
         completed = False
         while not completed:
             self.updateStatus()
-            completed = True
-            for k in range(self.nreplicas):
-                if self.status[k]['running_status'] == "R":
-                    completed = False
+            completed = self.running == 0
+            if not completed and until is not None and time.time() > until:
+                self.logger.warning("%d replicas still running are left out of the final checkpoint", self.running)
+                break
             time.sleep(1)
 
     def cleanJob(self):
@@ -347,6 +499,15 @@ class async_re(object):
         #defined in subclasses
         pass
 
+    def _updateNodePool(self):
+        #defined in subclasses, adds and removes compute devices while the job runs
+        pass
+
+    def _estimateFreeEnergy(self):
+        #defined in subclasses, returns the (free energy, standard error) from the samples
+        #collected so far or None if not available
+        return None
+
     def _write_status(self):
         pass
 
@@ -367,6 +528,14 @@ class async_re(object):
                      self.status[k]['cycle_current']))
         log += 'Running = %d\n'%self.running
         log += 'Waiting = %d\n'%self.waiting
+        if self.dgb_estimate is not None:
+            log += 'DGb = %f +- %f\n'%self.dgb_estimate
+        if self.nexchange_pools > 0:
+            log += 'Exchange pool = %.2f\n'%(self.exchange_pool_total/self.nexchange_pools)
+        if self.nholds > 0:
+            log += 'Exchange hold = %.3f s\n'%(self.hold_time/self.nholds)
+        if self.transport is not None:
+            log += self.transport.throughputStatus()
 
         logfile = '%s_stat.txt'%self.basename
         ofile = _open(logfile,'w')
@@ -391,20 +560,41 @@ class async_re(object):
                 #MD engine modules implement ways to check for completion.
                 #by testing existence of output file, etc.
                 if self._hasCompleted(replica,this_cycle):
-                    self.status[replica]['cycle_current'] += 1
+                    cycle = self._completedCycle(replica)
+                    self.status[replica]['cycle_current'] = cycle
+                    #a launch shortened in the tail phase completes only part of
+                    #the cycle, the replica is not exchanged until the cycle is completed
+                    self.status.set_midcycle(replica, cycle == this_cycle)
+                    if cycle > this_cycle:
+                        self.completion_time[replica] = time.time()
+                    else:
+                        self.completion_time[replica] = None
                 else:
                     self.logger.warning('_updateStatus_replica(): restarting replica %s (cycle %s)',
                                         replica, this_cycle)
+                    #drops any job of the replica left in the queue before it is relaunched
+                    self.transport.cancelJob(replica)
                 self.status[replica]['running_status'] = 'W'
         self.update_state_of_replica(replica)
 
+    def _completedCycle(self, replica):
+        #current cycle of a replica that has completed a run, as counted by the MD engine
+        return self.status[replica]['cycle_current'] + 1
+
+    def _numNodesStarting(self):
+        #number of compute devices being started, defined in subclasses
+        return 0
+
     def _njobs_to_run(self):
         # size of subjob buffer as a percentage of job slots
-        subjobs_buffer_size = self.keywords.get('SUBJOBS_BUFFER_SIZE')
+        # (tuned at runtime with ADAPTIVE_SCHEDULING)
+        subjobs_buffer_size = self.subjobs_buffer_size
         if subjobs_buffer_size is None:
-            subjobs_buffer_size = 0.5
-        else:
-            subjobs_buffer_size = float(subjobs_buffer_size)
+            subjobs_buffer_size = self.keywords.get('SUBJOBS_BUFFER_SIZE')
+            if subjobs_buffer_size is None:
+                subjobs_buffer_size = 0.5
+            else:
+                subjobs_buffer_size = float(subjobs_buffer_size)
 
         # launch new replicas if the number of submitted/running subjobs is
         # less than the number of available slots
@@ -424,24 +614,85 @@ class async_re(object):
     def _cycle_of_replica(self,repl):
         return self.status[repl]['cycle_current']
 
+    def _launchPriority(self, repl):
+        #user priority of a replica (REPLICA_PRIORITIES) plus a score in [0,1)
+        #of its state, see _allocationScore()
+        return self.replica_priority.get(repl, 0) + self._allocationScore(repl)
+
+    def _launch_key(self, repl):
+        return (-self._launchPriority(repl), self._cycle_of_replica(repl))
+
+    def _allocationScore(self, repl):
+        #defined in subclasses, favors replicas in the states that need more sampling
+        return 0.0
+
+    def _updateAllocation(self):
+        #defined in subclasses, updates the allocation of sampling among the states
+        pass
+
+    def _reprioritizeJobs(self):
+        #applies the current launch priorities to the replicas waiting in the transport queue
+        for k in self.replicas_running:
+            self.transport.reprioritizeJob(k, self._launchPriority(k))
+
     def launchJobs(self):
         """
         Scans the replicas in wait state and randomly launches them
         """
         jobs_to_launch = self._njobs_to_run()
         if jobs_to_launch > 0:
-            #prioritize replicas that are most behind
-            wait = sorted(self.replicas_waiting, key=self._cycle_of_replica)
+            #prioritize replicas with a higher launch priority
+            #and, among those, replicas that are most behind
+            wait = sorted(self.replicas_waiting, key=self._launch_key)
             #  random.shuffle(wait)
+            if self.exchange_window is not None:
+                now = time.time()
+                wait = [k for k in wait if not self._holdForExchange(k, now)]
             n = min(jobs_to_launch,len(wait))
             for k in wait[0:n]:
                 self.logger.info('Launching replica %d cycle %d', k, self.status[k]['cycle_current'])
+                if self.hold_since[k] is not None:
+                    self.hold_time += time.time() - self.hold_since[k]
+                    self.nholds += 1
+                    self.hold_since[k] = None
                 # the _launchReplica function is implemented by
                 # MD engine modules
                 status = self._launchReplica(k,self.status[k]['cycle_current'])
                 if status != None:
                     self.status[k]['running_status'] = 'R'
 
+    def _neighborStates(self, stateid):
+        #states with which a replica in stateid is most likely to exchange
+        return [s for s in (stateid - 1, stateid + 1) if 0 <= s < self.nreplicas]
+
+    def _holdForExchange(self, replica, now):
+        #true if a replica that has completed a cycle less than exchange_window seconds
+        #ago should wait for a replica in a neighboring state predicted to complete
+        #before the end of the window
+        if self.completion_time[replica] is None:
+            return False
+        window_end = self.completion_time[replica] + self.exchange_window
+        if now >= window_end:
+            return False
+        stateid = self.status[replica]['stateid_current']
+        for neighbor in self._neighborStates(stateid):
+            for k in np.flatnonzero(self.status.stateid == neighbor):
+                if self.status[k]['running_status'] != 'R':
+                    continue
+                completion = self.transport.predictedReplicaCompletion(k)
+                if completion is not None and completion <= window_end:
+                    if self.hold_since[replica] is None:
+                        self.hold_since[replica] = now
+                    return True
+        return False
+
+    def _logExchangeStats(self):
+        #average size of the exchange pools and hold time of the replicas in the exchange window
+        if self.nexchange_pools > 0:
+            self.logger.info("Average exchange pool size: %.2f replicas" % (self.exchange_pool_total/self.nexchange_pools))
+        if self.nholds > 0:
+            self.logger.info("Replicas held for exchanges: %d, average hold time %.3f s" % (self.nholds, self.hold_time/self.nholds))
+
     def doExchanges(self):
         """Perform exchanges among waiting replicas using Gibbs sampling."""
 
@@ -454,6 +705,8 @@ class async_re(object):
         nreplicas_to_exchange = len(replicas_to_exchange)
         if nreplicas_to_exchange < 2:
             return 0
+        self.exchange_pool_total += nreplicas_to_exchange
+        self.nexchange_pools += 1
 
         if self.verbose:
             self.logger.debug('Initiating exchanges amongst %d replicas:', nreplicas_to_exchange)
@@ -471,22 +724,12 @@ class async_re(object):
 
         sampling_start_time = time.time()
 
-        for repl_i in replicas_to_exchange:
-            #repl_i = choice(replicas_to_exchange)
-            sid_i = self.status[repl_i]['stateid_current']
-            curr_states = [self.status[repl_j]['stateid_current']
-                           for repl_j in replicas_to_exchange]
-            repl_j = pairwise_independence_sampling(repl_i,sid_i,
-                                                    replicas_to_exchange,
-                                                    curr_states,
-                                                    swap_matrix)
-            if repl_j != repl_i:
-                sid_i = self.status[repl_i]['stateid_current']
-                sid_j = self.status[repl_j]['stateid_current']
-                self.status[repl_i]['stateid_current'] = sid_j
-                self.status[repl_j]['stateid_current'] = sid_i
-                self.logger.info("Replica %d new state %d" % (repl_i, sid_j))
-                self.logger.info("Replica %d new state %d" % (repl_j, sid_i))
+        new_states = gibbs_exchange(replicas_to_exchange, states_to_exchange,
+                                    swap_matrix, self.exchange_sweeps)
+        for repl, sid_old, sid_new in zip(replicas_to_exchange, states_to_exchange, new_states):
+            if sid_new != sid_old:
+                self.status[repl]['stateid_current'] = sid_new
+                self.logger.info("Replica %d new state %d" % (repl, sid_new))
 
         # Uncomment to debug Gibbs sampling:
         # Actual and observed populations of state permutations should match.
@@ -495,6 +738,8 @@ class async_re(object):
         # self._debug_validate_state_populations(replicas_to_exchange,
         #                                        states_to_exchange,U)
         sampling_time = time.time() - sampling_start_time
+        if self.verbose:
+            self.logger.debug('swap matrix time: %f s, sampling time: %f s', matrix_time, sampling_time)
 
     # see children classes for specific implementations
     def update_state_of_replica(self, repl):
@@ -0,0 +1,57 @@
+"""
+Background writer of replica checkpoints for AsyncRE/OpenMM
+"""
+import time
+import threading
+import queue
+import logging
+
+from ommreplica import write_checkpoint_file
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoint snapshots in a separate thread so that the scheduler
+    can keep dispatching replicas while the files are written.
+
+    A snapshot is a list of (filename, arrays) pairs, see
+    OMMReplica.checkpoint_snapshot(). At most maxsize snapshots are held in
+    the queue; submit() blocks when the writer falls behind.
+    """
+    def __init__(self, maxsize = 2, logger = None):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger("async_re.checkpoint_writer")
+        self.queue = queue.Queue(maxsize)
+        #duration (s) of the last snapshot write
+        self.write_time = 0.0
+        self.thread = threading.Thread(target = self._run, name = "checkpoint writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, snapshot):
+        self.queue.put(snapshot)
+
+    def flush(self):
+        #waits until all of the submitted snapshots are on disk
+        self.queue.join()
+
+    def close(self):
+        #flushes pending snapshots and stops the writer thread
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            snapshot = self.queue.get()
+            try:
+                if snapshot is None:
+                    return
+                start_time = time.time()
+                for (filename, arrays) in snapshot:
+                    write_checkpoint_file(filename, arrays)
+                self.write_time = time.time() - start_time
+            except Exception as e:
+                self.logger.error("unable to write checkpoint: %s" % e)
+            finally:
+                self.queue.task_done()
@@ -1,7 +1,7 @@
 """Gibbs sampling routines"""
 from __future__ import print_function
 from __future__ import division
-from numpy import zeros, exp, sum, log, asarray
+from numpy import zeros, exp, sum, log, asarray, arange, array, ix_, cumsum, searchsorted, clip
 from numpy.random import random as _random
 from random import choice
 from itertools import permutations
@@ -118,3 +118,73 @@ def pairwise_independence_sampling(repl_i, sid_i, replicas, states, U):
               'list of waiting replicas?'%i)
 
     return replicas[weighted_choice(list(zip(range(nreplicas),ps)))]
+
+#largest set of replicas for which exchanges are sampled exactly
+#by enumerating all of the state permutations (6! = 720)
+EXACT_SAMPLING_MAX_REPLICAS = 6
+
+_permutations_cache = {}
+
+def _sample_index(weights):
+    """Return an index drawn with probability proportional to the given weights."""
+    c = cumsum(weights)
+    return int(searchsorted(c, _random()*c[-1], side='right'))
+
+def independence_sampling_sweeps(replicas, states, U, nsweeps = 1):
+    """
+    Return the new states of the given replicas after nsweeps sweeps of
+    pairwise independence sampling (see pairwise_independence_sampling()).
+
+    Each sweep attempts an exchange for each replica in turn. The swap
+    matrix block of the replicas is extracted once as an ndarray and the
+    swap probabilities of each replica with all of the others are evaluated
+    in one pass.  states[k] is the state currently occupied by replicas[k].
+    """
+    n = len(replicas)
+    u = asarray(U, dtype=float)[ix_(states, replicas)] # u[a][i]: energy of replica i in state a
+    perm = arange(n) # perm[i]: (local) state of replica i
+    idx = arange(n)
+    f = 1./(float(n) - 1.)
+    for sweep in range(nsweeps):
+        for i in range(n):
+            si = perm[i]
+            du = u[si,:] + u[perm,i] - u[si,i] - u[perm,idx]
+            ps = f*exp(-clip(du, 0., None))
+            ps[i] = 0.
+            ps[i] = max(0., 1. - sum(ps))
+            j = _sample_index(ps)
+            if j != i:
+                perm[i] = perm[j]
+                perm[j] = si
+    return [states[k] for k in perm]
+
+def exact_permutation_sampling(replicas, states, U):
+    """
+    Return the new states of the given replicas drawn directly from the
+    distribution of all of the replica/state permutations,
+
+    P(s) ~ exp[-sum_i u_s(i)(i)]
+
+    This is the limit of an infinite number of sweeps of pairwise sampling
+    and it is practical only for a small number of replicas.
+    """
+    n = len(replicas)
+    if n not in _permutations_cache:
+        _permutations_cache[n] = array(list(permutations(range(n))))
+    perms = _permutations_cache[n]
+    u = asarray(U, dtype=float)[ix_(states, replicas)]
+    e = sum(u[perms, arange(n)], axis=1)
+    w = exp(-(e - e.min()))
+    return [states[k] for k in perms[_sample_index(w)]]
+
+def gibbs_exchange(replicas, states, U, nsweeps = 1):
+    """
+    Return the new states of the given replicas. Sets of up to
+    EXACT_SAMPLING_MAX_REPLICAS replicas are sampled exactly, larger sets by
+    nsweeps sweeps of pairwise independence sampling.
+    """
+    if len(replicas) < 2:
+        return list(states)
+    if len(replicas) <= EXACT_SAMPLING_MAX_REPLICAS:
+        return exact_permutation_sampling(replicas, states, U)
+    return independence_sampling_sweeps(replicas, states, U, nsweeps)
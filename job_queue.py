@@ -0,0 +1,67 @@
+"""
+Priority queue of the replicas waiting to be launched
+"""
+import heapq
+import itertools
+
+class JobQueue(object):
+    """
+    In-process priority queue of replica ids. Replicas with a higher user
+    priority are launched first and, among those with the same priority, the
+    replicas that are most behind, i.e. with the lowest cycle, then in order
+    of insertion.
+
+    The queue is a binary heap with lazy deletion: reprioritizing or removing
+    a replica marks its heap entry as removed in O(1) and pushes a new entry in
+    O(log n). Removed entries are discarded when they reach the top.
+    """
+    _REMOVED = -1
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, replica):
+        return replica in self._entries
+
+    def empty(self):
+        return len(self._entries) == 0
+
+    def qsize(self):
+        return len(self._entries)
+
+    def put(self, replica, cycle, priority = 0):
+        #adds a replica, or changes its position if it is already in the queue
+        if replica in self._entries:
+            self.remove(replica)
+        entry = [-priority, cycle, next(self._counter), replica]
+        self._entries[replica] = entry
+        heapq.heappush(self._heap, entry)
+
+    def update(self, replica, cycle = None, priority = None):
+        #changes the cycle and/or the priority of a replica in the queue
+        entry = self._entries[replica]
+        if cycle is None:
+            cycle = entry[1]
+        if priority is None:
+            priority = -entry[0]
+        self.put(replica, cycle, priority)
+
+    def remove(self, replica):
+        #removes a replica from the queue, KeyError if not in the queue
+        entry = self._entries.pop(replica)
+        entry[-1] = self._REMOVED
+
+    def get(self):
+        #removes and returns the replica at the top of the queue, IndexError if empty
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            replica = entry[-1]
+            if replica != self._REMOVED:
+                del self._entries[replica]
+                return replica
+        raise IndexError("get from an empty job queue")
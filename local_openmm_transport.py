@@ -4,6 +4,9 @@ from __future__ import division
 Multiprocessing job transport for AsyncRE/OpenMM
 """
 import os, re, sys, time, shutil, copy, random, signal
+import math
+import queue
+import numpy as np
 import multiprocessing as mp
 #from multiprocessing import Process, Queue, Event
 import logging
@@ -21,12 +24,13 @@ from ommworker import *
 from contextlib import contextmanager
 
 from transport import Transport
+from job_queue import JobQueue
 
 class LocalOpenMMTransport(Transport):
     """
     Class to launch and monitor jobs on a set of local GPUs
     """
-    def __init__(self, jobname, openmm_workers, openmm_replicas):
+    def __init__(self, jobname, openmm_workers, openmm_replicas, completion_queue = None):
         # jobname: identifies current asyncRE job
         Transport.__init__(self)
         self.logger = logging.getLogger("async_re.local_openmm_transport")
@@ -48,14 +52,53 @@ class LocalOpenMMTransport(Transport):
         # None = no information about where the replica is running
         self.replica_to_job = [ None for k in range(len(openmm_replicas)) ]
 
-        # implements a queue of jobs from which to draw the next job
-        # to launch
-        ctx = mp.get_context('spawn')
-        self.jobqueue = ctx.Queue()
+        # priority queue of the replicas waiting to be launched, most
+        # behind first, see job_queue.JobQueue
+        self.jobqueue = JobQueue()
 
         self.ncrashes = [ 0 for k in range(self.nprocs)]
         self.disabled = [ False for k in range(self.nprocs)]
         self.maxcrashes = 4
+        # nodes of removed slots, retired once their current cycle is done
+        self.draining = [ False for k in range(self.nprocs)]
+
+        # replica affinity: the node that last ran each replica and, for each
+        # node, the (replica, posvel version) whose coordinates are in its context
+        self.last_node = [ None for k in range(len(openmm_replicas)) ]
+        self.node_holds = [ None for k in range(self.nprocs)]
+        self.affinity_hits = 0
+        self.affinity_launches = 0
+
+        # queue on which the workers post (replica, completion time) when done
+        # if None the workers are polled every mintime seconds
+        self.completionq = completion_queue
+
+        # device idle time accounting: time at which each device was
+        # last freed, accumulated idle time and number of launches
+        now = time.time()
+        self.idle_since = [ now for k in range(self.nprocs)]
+        self.idle_time = [ 0.0 for k in range(self.nprocs)]
+        self.nlaunches = [ 0 for k in range(self.nprocs)]
+
+        # moving average of the MD steps per second of each device, None until
+        # measured, and the weight of the latest cycle in the average
+        self.steps_per_second = [ None for k in range(self.nprocs)]
+        self.speed_smoothing = 0.3
+        self.fast_launches = 0
+        # moving average of the wall clock duration of a cycle on each device,
+        # from launch to completion
+        self.cycle_seconds = [ None for k in range(self.nprocs)]
+        # moving average of the time of a cycle not spent in MD (dispatch, reply)
+        self.overhead_seconds = [ 0.0 for k in range(self.nprocs)]
+
+        # tail phase: when deadline is set, launches are shortened so that they
+        # are predicted to complete before it, in multiples of 1/tail_granularity
+        # of a cycle. deadline_blocked is set when even the shortest launch does
+        # not fit on any free device
+        self.deadline = None
+        self.tail_granularity = 10
+        self.deadline_blocked = False
+        self.tail_launches = 0
 
     def _clear_resource(self, replica):
         # frees up the node running a replica identified by replica id
@@ -83,6 +126,7 @@ class LocalOpenMMTransport(Transport):
         return nodeid
 
     def numNodesAlive(self):
+        #a draining node is alive until it is retired
         alive = [node for node in range(self.nprocs)
                      if self.node_status[node] is None or self.node_status[node] >= 0 ]
         return len(alive)
@@ -93,6 +137,7 @@ class LocalOpenMMTransport(Transport):
                 if self.ncrashes[nodeid] <= self.maxcrashes:
                     self.ncrashes[nodeid] += 1
                     self.logger.warning("fixnodes(): attempting to restart nodeid %d", nodeid)
+                    self.node_holds[nodeid] = None
                     res = self.openmm_workers[nodeid].start_worker()
                     if res is not None:
                         self.node_status[nodeid] = None
@@ -100,16 +145,176 @@ class LocalOpenMMTransport(Transport):
                     self.logger.warning("fixnodes(): node %d has crashed too many times; it will not be restarted.", nodeid)
                     self.disabled[nodeid] = True
 
-    def _availableNode(self):
+    def addWorker(self, worker):
+        #adds the node of a started worker, returns its node id
+        nodeid = self.nprocs
+        self.openmm_workers.append(worker)
+        self.nprocs += 1
+        self.node_status.append(None)
+        self.ncrashes.append(0)
+        self.disabled.append(False)
+        self.draining.append(False)
+        self.node_holds.append(None)
+        self.idle_since.append(time.time())
+        self.idle_time.append(0.0)
+        self.nlaunches.append(0)
+        self.steps_per_second.append(None)
+        self.cycle_seconds.append(None)
+        self.overhead_seconds.append(0.0)
+        self.logger.info("added node %d (%s)", nodeid, worker.name())
+        return nodeid
+
+    def drainNode(self, nodeid):
+        #no more replicas are launched on the node, which is retired when its
+        #current replica completes; the replica then goes back to the wait state
+        if self.draining[nodeid] or self.disabled[nodeid]:
+            return
+        self.draining[nodeid] = True
+        self.logger.info("draining node %d (%s)", nodeid, self.openmm_workers[nodeid].name())
+
+    def undrainNode(self, nodeid):
+        #cancels the drain of a node that has not been retired yet
+        if not self.draining[nodeid] or self.disabled[nodeid]:
+            return
+        self.draining[nodeid] = False
+        self.logger.info("node %d (%s) no longer draining", nodeid, self.openmm_workers[nodeid].name())
+
+    def _retireNodes(self):
+        for nodeid in range(self.nprocs):
+            if self.draining[nodeid] and not self.disabled[nodeid]:
+                if self.node_status[nodeid] is None or self.node_status[nodeid] < 0:
+                    #a crashed worker has already been stopped
+                    if self.node_status[nodeid] is None:
+                        self.openmm_workers[nodeid].finish()
+                    self.node_status[nodeid] = -1
+                    self.node_holds[nodeid] = None
+                    self.disabled[nodeid] = True
+                    self.logger.info("retired node %d (%s)", nodeid, self.openmm_workers[nodeid].name())
+
+    def enabledNodes(self):
+        #nodes that are not retired, including the nodes being drained
+        return [node for node in range(self.nprocs) if not self.disabled[node]]
+
+    def activeNodes(self):
+        #nodes that are neither retired nor being drained
+        return [node for node in range(self.nprocs) if not self.disabled[node] and not self.draining[node]]
+
+    def _availableNode(self, replica = None, lagging = False):
         #returns a node at random among available nodes
-        available = [node for node in range(self.nprocs)
-                     if self.node_status[node] is None]
+        #if a replica is given, the node that last ran it is preferred, then nodes
+        #that do not hold the coordinates of other replicas waiting in the queue
+        #a lagging replica goes to the fastest available node
+        #returns (node, by_speed), by_speed is true if the node was picked by its speed
+        available = self._freeNodes()
 
         if available == None or len(available) == 0:
-            return None
+            return (None, False)
+        if replica is not None and lagging:
+            fastest = self._fastestNode(available)
+            if fastest is not None:
+                return (fastest, True)
+        if replica is not None:
+            if self.last_node[replica] in available:
+                return (self.last_node[replica], False)
+            free = [node for node in available
+                    if self.node_holds[node] is None or self.node_holds[node][0] not in self.jobqueue]
+            if len(free) > 0:
+                available = free
         random.shuffle(available)
 
-        return available[0]
+        return (available[0], False)
+
+    def _freeNodes(self):
+        return [node for node in range(self.nprocs)
+                if self.node_status[node] is None and not self.draining[node]]
+
+    def _fastestNode(self, nodes):
+        #returns the node with the highest measured speed, None if no speed is known.
+        #Nodes not yet measured are assumed to run at the average speed
+        measured = [self.steps_per_second[node] for node in nodes if self.steps_per_second[node] is not None]
+        if len(measured) == 0:
+            return None
+        average = sum(measured)/len(measured)
+        speed = lambda node: self.steps_per_second[node] if self.steps_per_second[node] is not None else average
+        return max(nodes, key = speed)
+
+    def _updateSpeed(self, node, nsteps, md_time, cycle_time):
+        if md_time is None or md_time <= 0:
+            return
+        sps = nsteps/md_time
+        overhead = max(cycle_time - md_time, 0.0)
+        if self.steps_per_second[node] is None:
+            self.steps_per_second[node] = sps
+            self.cycle_seconds[node] = cycle_time
+            self.overhead_seconds[node] = overhead
+        else:
+            self.steps_per_second[node] += self.speed_smoothing*(sps - self.steps_per_second[node])
+            self.cycle_seconds[node] += self.speed_smoothing*(cycle_time - self.cycle_seconds[node])
+            self.overhead_seconds[node] += self.speed_smoothing*(overhead - self.overhead_seconds[node])
+
+    def predictedDuration(self, node, nsteps):
+        #predicted wall clock time (s) of a run of nsteps on a node, None if its speed is unknown
+        if self.steps_per_second[node] is None:
+            return None
+        return nsteps/self.steps_per_second[node] + self.overhead_seconds[node]
+
+    def predictedCompletion(self, node):
+        #predicted time at which the replica running on a node completes, None if idle or unknown
+        replica = self.node_status[node]
+        if replica is None or replica < 0:
+            return None
+        job = self.replica_to_job[replica]
+        if job is None or 'nodeid' not in job:
+            return None
+        duration = self.predictedDuration(node, job['nsteps'])
+        if duration is None:
+            return None
+        return job['start_time'] + duration
+
+    def predictedReplicaCompletion(self, replica):
+        job = self.replica_to_job[replica]
+        if job is None or 'nodeid' not in job:
+            return None
+        return self.predictedCompletion(job['nodeid'])
+
+    def _tailSteps(self, node, nsteps, now):
+        #number of steps, in multiples of the tail granularity, of a launch on a node
+        #that is predicted to complete before the deadline. 0 if none fits, nsteps if
+        #there is no deadline or the speed of the node is unknown
+        if self.deadline is None or self.steps_per_second[node] is None:
+            return nsteps
+        available = self.deadline - now - self.overhead_seconds[node]
+        if self.predictedDuration(node, nsteps) <= self.deadline - now:
+            return nsteps
+        chunk = max(1, nsteps//self.tail_granularity)
+        return max(0, min(nsteps, int(available*self.steps_per_second[node])//chunk*chunk))
+
+    def nodesRunning(self):
+        return len([node for node in range(self.nprocs)
+                    if self.node_status[node] is not None and self.node_status[node] >= 0])
+
+    def cycleDurations(self):
+        return [self.cycle_seconds[node] for node in range(self.nprocs)
+                if self.cycle_seconds[node] is not None and not self.disabled[node]]
+
+    def idleTime(self):
+        return sum(self.idle_time)
+
+    def throughputStatus(self):
+        #steps per second, ns/day and predicted completion time (s from now) of each device
+        log = 'Node  Steps/s     ns/day     Done  Worker\n'
+        now = time.time()
+        for nodeid in range(self.nprocs):
+            worker = self.openmm_workers[nodeid]
+            sps = self.steps_per_second[nodeid]
+            completion = self.predictedCompletion(nodeid)
+            done = '%8.1f' % (completion - now) if completion is not None else '%8s' % '-'
+            if sps is None:
+                log += '%4d  %7s  %9s %s  %s\n' % (nodeid, '-', '-', done, worker.name())
+            else:
+                nsday = sps*(worker.ommsystem.MDstepsize/nanosecond)*86400.0
+                log += '%4d  %7.1f  %9.2f %s  %s\n' % (nodeid, sps, nsday, done, worker.name())
+        return log
 
     def launchJob(self, replica, job_info):
         #Enqueues a replica for running based on provided job info.
@@ -117,38 +322,143 @@ class LocalOpenMMTransport(Transport):
         job['replica'] = replica
         job['start_time'] = 0
         self.replica_to_job[replica] = job
-        self.jobqueue.put(replica)
-        return self.jobqueue.qsize()
+        self.jobqueue.put(replica, job['cycle'], job.get('priority', 0))
+        return len(self.jobqueue)
+
+    def reprioritizeJob(self, replica, priority):
+        #changes the user priority of a replica waiting in the queue
+        if replica in self.jobqueue:
+            self.replica_to_job[replica]['priority'] = priority
+            self.jobqueue.update(replica, priority = priority)
+
+    def cancelJob(self, replica):
+        #removes a replica from the queue; it is then considered done
+        if replica in self.jobqueue:
+            self.jobqueue.remove(replica)
+            self._clear_resource(replica)
+            self.replica_to_job[replica] = None
 
     def LaunchReplica(self, worker, replica, cycle, nsteps,
-                      nheating = 0, ncooling = 0, hightemp = 0.0):
+                      nheating = 0, ncooling = 0, hightemp = 0.0, send_posvel = True):
         (stateid, par) = replica.get_state()
-        worker.set_posvel(replica.positions, replica.velocities)
-        worker.set_state(par)
-        worker.run(nsteps, nheating, ncooling, hightemp)
+        if send_posvel:
+            worker.run_cycle(par, replica.positions, replica.velocities, nsteps,
+                             nheating, ncooling, hightemp, tag = replica._id,
+                             boxvectors = replica.boxvectors)
+        else:
+            #the worker's context already holds the coordinates of the replica
+            worker.run_cycle(par, None, None, nsteps,
+                             nheating, ncooling, hightemp, tag = replica._id)
+
+    def logTimings(self):
+        #reports device idle time and per-worker MD time and protocol latencies per cycle
+        self.logger.info("Average device idle time per cycle: %.3f s" % self.idleTimePerCycle())
+        if self.affinity_launches > 0:
+            self.logger.info("Replica affinity hits: %d of %d launches (%.1f%%)" % (self.affinity_hits, self.affinity_launches, 100.*self.affinity_hits/self.affinity_launches))
+        for nodeid in range(self.nprocs):
+            t = self.openmm_workers[nodeid].cycle_timings()
+            if t is not None:
+                self.logger.info("Node %d: MD time %.3f s, dispatch latency %.3f s, reply latency %.3f s per cycle" % (nodeid, t['md'], t['dispatch'], t['reply']))
+            if self.steps_per_second[nodeid] is not None:
+                self.logger.info("Node %d: %.1f MD steps/s" % (nodeid, self.steps_per_second[nodeid]))
+        self.logger.info("Lagging replicas sent to the fastest free device: %d" % self.fast_launches)
+        if self.tail_launches > 0:
+            self.logger.info("Launches shortened to meet the deadline: %d" % self.tail_launches)
+
+    def idleTimePerCycle(self):
+        #average time a device sat idle in between the completion of a replica and the next launch
+        nlaunches = sum(self.nlaunches)
+        if nlaunches == 0:
+            return 0.0
+        return sum(self.idle_time)/nlaunches
+
+    def _harvestCompletions(self, timeout):
+        #waits up to timeout seconds for workers to report completed replicas and
+        #harvests them. Returns the number of replicas harvested.
+        ndone = 0
+        try:
+            msg = self.completionq.get(timeout = timeout)
+        except queue.Empty:
+            return 0
+        while msg is not None:
+            (replica, done_time) = msg
+            job = self.replica_to_job[replica]
+            #stale notifications of replicas already harvested by polling are ignored
+            if job is not None and 'nodeid' in job and done_time >= job['start_time']:
+                job['done_time'] = done_time
+                if self.isDone(replica, 0):
+                    ndone += 1
+            try:
+                msg = self.completionq.get_nowait()
+            except queue.Empty:
+                msg = None
+        return ndone
 
     def ProcessJobQueue(self, mintime, maxtime):
         #Launches jobs waiting in the queue.
         #It will scan free devices and job queue up to maxtime.
-        #If the queue becomes empty, it will still block until maxtime is elapsed.
+        #With a completion queue it returns as soon as one or more replicas are done
+        #so that they can be exchanged and relaunched right away. Otherwise, or if no
+        #replica completes, it blocks until maxtime is elapsed.
         njobs_launched = 0
         nreplicas = len(self.replica_to_job)
 
+        #replicas behind the average cycle are sent to the fastest free device
+        cycles = [replica.get_cycle() for replica in self.openmm_replicas]
+        average_cycle = sum(cycles)/len(cycles)
+
         when_started = time.time()
         while time.time() < when_started + maxtime:
             # find an available node
-            node = self._availableNode()
+            (node, by_speed) = self._availableNode()
             while (not self.jobqueue.empty()) and (not node == None):
 
                 # grabs job on top of the queue
                 replica = self.jobqueue.get()
                 job = self.replica_to_job[replica]
 
+                # picks the node, preferably the one holding the replica's coordinates
+                lagging = cycles[replica] < average_cycle
+                (node, by_speed) = self._availableNode(replica, lagging)
+
+                # in the tail phase the launch is shortened to complete before the
+                # deadline, on the fastest free node if it does not fit on this one.
+                # It is put back in the queue if it does not fit anywhere
+                nsteps = self._tailSteps(node, job['nsteps'], time.time())
+                if nsteps == 0:
+                    node = self._fastestNode(self._freeNodes())
+                    by_speed = False
+                    nsteps = self._tailSteps(node, job['nsteps'], time.time())
+                if nsteps == 0:
+                    if not self.deadline_blocked:
+                        self.logger.info("tail: no launch fits before the deadline")
+                    self.deadline_blocked = True
+                    self.jobqueue.put(replica, job['cycle'], job.get('priority', 0))
+                    break
+                if nsteps < job['nsteps']:
+                    self.logger.info("tail: replica %d shortened to %d steps on node %d (deadline in %.1f s)",
+                                     replica, nsteps, node, self.deadline - time.time())
+                    job['nsteps'] = nsteps
+                    self.tail_launches += 1
+                self.deadline_blocked = False
+
+                if by_speed:
+                    self.fast_launches += 1
+                hit = self.node_holds[node] == (replica, self.openmm_replicas[replica].posvel_version)
+                self.affinity_launches += 1
+                if hit:
+                    self.affinity_hits += 1
+                    self.logger.debug("Replica %d relaunched on node %d holding its coordinates", replica, node)
+                self.last_node[replica] = node
+                self.node_holds[node] = None
+
                 # assign job to available node
                 job['nodeid'] = node
                 job['openmm_replica'] = self.openmm_replicas[replica]
                 job['openmm_worker'] = self.openmm_workers[node]
                 job['start_time'] = time.time()
+                self.idle_time[node] += job['start_time'] - self.idle_since[node]
+                self.nlaunches[node] += 1
 
                 # connects node to replica
                 self.replica_to_job[replica] = job
@@ -164,59 +474,67 @@ class LocalOpenMMTransport(Transport):
                     hightemp = 0.0
 
                 self.LaunchReplica(job['openmm_worker'], job['openmm_replica'], job['cycle'],
-                                   job['nsteps'], nheating, ncooling, hightemp)
+                                   job['nsteps'], nheating, ncooling, hightemp, send_posvel = not hit)
 
                 # updates number of jobs launched
                 njobs_launched += 1
 
-                node = self._availableNode()
+                (node, by_speed) = self._availableNode()
 
-            # waits mintime second and rescans job queue
-            time.sleep(mintime)
+            if self.completionq is None:
+                # waits mintime second and rescans job queue
+                time.sleep(mintime)
+                nharvested = 0
+            else:
+                # waits up to mintime seconds for a worker to report a completion
+                timeout = max(0, min(mintime, when_started + maxtime - time.time()))
+                nharvested = self._harvestCompletions(timeout)
 
             # updates set of free nodes by checking for replicas that have exited
+            # (crashed workers do not report completions)
             for repl in range(nreplicas):
                 self.isDone(repl,0)
 
-            #restarts crashed nodes if any
+            #retires the drained nodes and restarts crashed nodes if any
+            self._retireNodes()
             self._fixnodes()
 
+            if nharvested > 0:
+                break
+
         return njobs_launched
 
     def DrainJobQueue(self):
         #clear the job queue
-        while not self.jobqueue.empty():
-            # grabs job on top of the queue
-            replica = self.jobqueue.get()
-            self._clear_resource(replica)
-            self.replica_to_job[replica] = None
+        for replica in range(len(self.replica_to_job)):
+            self.cancelJob(replica)
 
     def _update_replica(self, job):
         #update replica cycle, mdsteps, write out, etc. from worker
         ommreplica = job['openmm_replica']
         if job['openmm_worker'].has_crashed(): #refuses to update replica from a crashed worker
             return None
-        (pos,vel) = job['openmm_worker'].get_posvel()
-        pot = job['openmm_worker'].get_energy()
+        (pos,vel,pot) = job['openmm_worker'].get_cycle_result()
         if pos is None or vel is None or pot is None:
             return None
         for value in pot.values():
             if math.isnan(value._value):
                 return None
-        for p in pos:
-            if math.isnan(p.x) or math.isnan(p.y) or math.isnan(p.z):
-                return None
-        for v in vel:
-            if math.isnan(v.x) or math.isnan(v.y) or math.isnan(v.z):
-                return None
-        cycle = ommreplica.get_cycle() + 1
-        ommreplica.set_cycle(cycle)
+        if np.isnan(pos._value).any() or np.isnan(vel._value).any():
+            return None
         mdsteps = ommreplica.get_mdsteps() + job['nsteps']
         ommreplica.set_mdsteps(mdsteps)
+        #a cycle shortened in the tail phase is counted when it is completed
+        if mdsteps % job.get('cycle_steps', job['nsteps']) == 0:
+            ommreplica.set_cycle(ommreplica.get_cycle() + 1)
         #update positions and velocities of openmm replica
         ommreplica.set_posvel(pos,vel)
+        ommreplica.set_boxvectors(job['openmm_worker'].boxvectors)
+        self._updateSpeed(job['nodeid'], job['nsteps'], job['openmm_worker'].last_md_time,
+                          job.get('done_time', time.time()) - job['start_time'])
+        #the worker's context now holds the coordinates of the replica
+        self.node_holds[job['nodeid']] = (ommreplica._id, ommreplica.posvel_version)
 
-        #TODO: should also update boxsize
         #update energies of openmm replica
         ommreplica.set_energy(pot)
         #output data and trajectory file update 
@@ -260,6 +578,8 @@ class LocalOpenMMTransport(Transport):
                 done = openmm_worker.is_running() and openmm_worker.is_done()
 
             if done:
+                #the device is idle from the time the worker completed the run
+                self.idle_since[job['nodeid']] = job.get('done_time', time.time())
                 #update replica info
                 openmm_worker._runningSignal.clear()
                 retcode = self._update_replica(job)
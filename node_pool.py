@@ -0,0 +1,83 @@
+"""
+Compute node slots of an asynchronous RE job
+
+The slots are read from the nodefile, one per line with six comma-separated
+columns: node name, slot number (platform:device), number of threads,
+platform, user name and temporary folder. Slots can be added and removed
+while the job runs by editing the nodefile or, if a control directory is
+given, by adding and removing files with the .node extension holding lines
+in the same format.
+"""
+import os
+import glob
+
+NODE_COLUMNS = ('node_name', 'slot_number', 'threads_number', 'arch', 'user_name', 'tmp_folder')
+
+def read_nodefile(filename):
+    """
+    Returns the list of the slots of a nodefile as dictionaries. Raises
+    ValueError if a line is malformed.
+    """
+    nodes = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            values = line.split(",")
+            if len(values) < len(NODE_COLUMNS):
+                raise ValueError("expected %d columns in nodefile line: %s" % (len(NODE_COLUMNS), line.strip()))
+            node = {name: str(value.strip()) for name, value in zip(NODE_COLUMNS, values)}
+            #tmp_folder has to be pre-assigned
+            if node["tmp_folder"] == "":
+                raise ValueError("tmp_folder in nodefile needs to be specified")
+            nodes.append(node)
+    return nodes
+
+def node_key(node):
+    #identifies a slot; the workers sharing a slot have the same key
+    return (node["node_name"], node["slot_number"])
+
+class NodePool(object):
+    """
+    Watches the nodefile and the control directory for changes of the set of
+    slots. changed() is true when any of the files was added, removed or
+    modified since the last call to nodes().
+    """
+    def __init__(self, nodefile, control_dir = None):
+        self.nodefile = nodefile
+        self.control_dir = control_dir
+        self._signature = self._files_signature()
+
+    def _files(self):
+        files = [self.nodefile]
+        if self.control_dir is not None:
+            files += sorted(glob.glob(os.path.join(self.control_dir, "*.node")))
+        return files
+
+    def _files_signature(self):
+        signature = []
+        for filename in self._files():
+            try:
+                st = os.stat(filename)
+                signature.append((filename, st.st_mtime, st.st_size))
+            except OSError:
+                signature.append((filename, None, None))
+        return signature
+
+    def changed(self):
+        return self._files_signature() != self._signature
+
+    def nodes(self):
+        """
+        Returns the current slots, each slot once. Raises ValueError or
+        IOError if the nodefile or a control file cannot be read.
+        """
+        self._signature = self._files_signature()
+        nodes = []
+        keys = set()
+        for filename in self._files():
+            for node in read_nodefile(filename):
+                if node_key(node) not in keys:
+                    keys.add(node_key(node))
+                    nodes.append(node)
+        return nodes
@@ -3,7 +3,9 @@ from __future__ import print_function
 Multiprocessing job transport for AsyncRE/OpenMM
 """
 import os, re, sys, time, shutil, copy, random, signal
+import zlib, zipfile
 import logging
+import numpy as np
 
 from simtk import openmm as mm
 from simtk.openmm.app import *
@@ -13,12 +15,70 @@ from datetime import datetime
 
 from atmmetaforce import *
 from ommworker import *
+from ommsystem import _as_array
+from sample_log import SampleLogWriter, sample_log_dir, has_samples, read_legacy_out
+
+def _checkpoint_checksum(arrays):
+    crc = 0
+    for name in sorted(arrays):
+        if name != 'checksum':
+            crc = zlib.crc32(name.encode(), crc)
+            crc = zlib.crc32(np.ascontiguousarray(arrays[name]).tobytes(), crc)
+    return crc
+
+def write_checkpoint_file(filename, arrays):
+    """
+    Writes a dictionary of arrays to a binary (npz) checkpoint file together
+    with a CRC32 checksum. The file is written under a temporary name and then
+    renamed so that an interrupted write never replaces a good checkpoint.
+    """
+    arrays = dict(arrays)
+    arrays['checksum'] = np.array(_checkpoint_checksum(arrays), dtype=np.uint32)
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpfile, filename)
+
+def read_checkpoint_file(filename):
+    """
+    Returns the dictionary of arrays stored in a binary checkpoint file,
+    None if the file is unreadable or the checksum does not match.
+    """
+    try:
+        with np.load(filename) as data:
+            arrays = {name: data[name] for name in data.files}
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        return None
+    checksum = arrays.pop('checksum', None)
+    if checksum is None or int(checksum) != _checkpoint_checksum(arrays):
+        return None
+    return arrays
+
+class ReplicaStateStore(object):
+    """
+    Positions (nm) and velocities (nm/ps) of all of the replicas held in one
+    contiguous (2, nreplicas, natoms, 3) float64 array, memory-mapped from
+    filename if given. OMMReplica objects keep views into their rows so that
+    copies and velocity rescaling are array operations.
+    """
+    def __init__(self, nreplicas, natoms, filename = None):
+        shape = (2, nreplicas, natoms, 3)
+        if filename is None:
+            self.posvel = np.zeros(shape, dtype=np.float64)
+        else:
+            self.posvel = np.memmap(filename, dtype=np.float64, mode='w+', shape=shape)
+        self.positions = self.posvel[0]
+        self.velocities = self.posvel[1]
 
 class OMMReplica(object):
     #
     # Holds and manages OpenMM state for a replica
     #
-    def __init__(self, replica_id, basename, worker, logger):
+    # positions and velocities are held in row replica_id of store, or in a
+    # private ReplicaStateStore if store is None
+    def __init__(self, replica_id, basename, worker, logger, store = None):
         self._id = replica_id
         self.basename = basename
         self.worker = worker
@@ -30,11 +90,22 @@ class OMMReplica(object):
         self.cycle = 1
         self.stateid = None
         self.mdsteps = 0
-        self.outfile = None
+        self.sample_log = None
+        #incremented whenever positions or velocities change
+        self.posvel_version = 0
 
         state = self.context.getState(getPositions=True, getVelocities=True)
-        self.positions = state.getPositions()
-        self.velocities = state.getVelocities()
+        positions = state.getPositions(asNumpy=True)
+        if store is None:
+            store = ReplicaStateStore(1, len(positions))
+            row = 0
+        else:
+            row = replica_id
+        self._positions = store.positions[row]
+        self._velocities = store.velocities[row]
+        self.positions = positions
+        self.velocities = state.getVelocities(asNumpy=True)
+        self.boxvectors = state.getPeriodicBoxVectors()
 
         if not os.path.isdir('r%d' % self._id):
             os.mkdir('r%d' % self._id)
@@ -42,13 +113,13 @@ class OMMReplica(object):
         self.open_out()
         #may override stateid, positions, etc.
         self.load_checkpoint()
-        self.open_dcd()
+        #set by open_dcd()
+        self.trajectory_writer = None
 
     def set_state(self, stateid, par):
         self.stateid = int(stateid)
         self.par = copy.deepcopy(par)
         self.is_state_assigned = True
-        self.update_context_from_state()
         
     def get_state(self):
         return (self.stateid, self.par)
@@ -59,45 +130,107 @@ class OMMReplica(object):
     def set_energy(self, pot):
         self.pot = copy.deepcopy(pot)
         
+    #Quantity views of the rows of the state store
+    @property
+    def positions(self):
+        return Quantity(self._positions, nanometer)
+
+    @positions.setter
+    def positions(self, positions):
+        self._positions[:] = _as_array(positions, nanometer)
+
+    @property
+    def velocities(self):
+        return Quantity(self._velocities, nanometer/picosecond)
+
+    @velocities.setter
+    def velocities(self, velocities):
+        self._velocities[:] = _as_array(velocities, nanometer/picosecond)
+
     def set_posvel(self, positions, velocities):
-        self.positions = copy.deepcopy(positions)
-        self.velocities = copy.deepcopy(velocities)
+        #copies into the state store
+        self.positions = positions
+        self.velocities = velocities
+        self.posvel_version += 1
+
+    def scale_velocities(self, scale):
+        self._velocities *= scale
+        self.posvel_version += 1
 
     def open_out(self):
-        outfilename =  'r%d/%s.out' % (self._id,self.basename)
-        self.outfile = open(outfilename, 'a+')
-        if self.outfile is None:
-            self.logger.warning("unable to open outfile %s" % outfilename)
+        #binary sample log, see sample_log.py. The samples of a job started
+        #with the legacy text files are imported first
+        dirname = sample_log_dir(self._id, self.basename)
+        outfile = 'r%d/%s.out' % (self._id, self.basename)
+        if not has_samples(dirname) and os.path.isfile(outfile):
+            self.logger.info("importing the samples of %s" % outfile)
+            read_legacy_out(outfile, dirname, self._id)
+        self.sample_log = SampleLogWriter(dirname)
+
+    def flush_out(self):
+        self.sample_log.flush()
 
     def load_checkpoint(self):
-        ckptfile = 'r%d/%s_ckpt.xml' % (self._id,self.basename)
+        #binary checkpoint, see save_checkpoint()
+        ckptfile = 'r%d/%s_ckpt.npz' % (self._id,self.basename)
         if os.path.isfile(ckptfile):
-            self.logger.info("Loading checkpointfile %s" % ckptfile) 
-            self.worker.simulation.loadState(ckptfile)
+            self.logger.info("Loading checkpointfile %s" % ckptfile)
+            arrays = read_checkpoint_file(ckptfile)
+            if arrays is not None:
+                self.update_state_from_arrays(arrays)
+                return
+            self.logger.warning("checkpoint file %s is corrupted" % ckptfile)
+        #OpenMM XML checkpoint written by earlier versions
+        xmlckptfile = 'r%d/%s_ckpt.xml' % (self._id,self.basename)
+        if os.path.isfile(xmlckptfile):
+            self.logger.info("Loading checkpointfile %s" % xmlckptfile)
+            self.worker.simulation.loadState(xmlckptfile)
             self.update_state_from_context()
+            self.boxvectors = self.context.getState().getPeriodicBoxVectors()
+        elif os.path.isfile(ckptfile):
+            raise IOError("unable to load corrupted checkpoint file %s" % ckptfile)
 
     def save_checkpoint(self):
-        ckptfile = 'r%d/%s_ckpt.xml' % (self._id,self.basename)
-        self.update_context_from_state()
-        self.worker.simulation.saveState(ckptfile)
+        #positions, velocities, box, state and energies in OpenMM units as float64 arrays
+        write_checkpoint_file(*self.checkpoint_snapshot())
+
+    def checkpoint_snapshot(self):
+        #returns the checkpoint file name and a copy of the checkpoint arrays
+        #that can be written while the replica keeps changing
+        ckptfile = 'r%d/%s_ckpt.npz' % (self._id,self.basename)
+        arrays = {name: np.array(value) for name, value in self.checkpoint_arrays().items()}
+        return (ckptfile, arrays)
+
+    def checkpoint_arrays(self):
+        arrays = {}
+        arrays['positions'] = self._positions
+        arrays['velocities'] = self._velocities
+        arrays['box'] = np.asarray(self.boxvectors.value_in_unit(nanometer), dtype=np.float64)
+        arrays['stateid'] = np.array(self.stateid, dtype=np.int64)
+        arrays['cycle'] = np.array(self.cycle, dtype=np.int64)
+        arrays['mdsteps'] = np.array(self.mdsteps, dtype=np.int64)
+        return arrays
+
+    def update_state_from_arrays(self, arrays):
+        self.cycle = int(arrays['cycle'])
+        self.stateid = int(arrays['stateid'])
+        self.mdsteps = int(arrays['mdsteps'])
+        self._positions[:] = arrays['positions']
+        self._velocities[:] = arrays['velocities']
+        self.boxvectors = Quantity([Vec3(*v) for v in arrays['box']], nanometer)
+        self.posvel_version += 1
         
-    def open_dcd(self):
+    def open_dcd(self, trajectory_writer):
+        #frames are written by trajectory_writer, see trajectory_writer.py
         dcdfilename =  'r%d/%s.dcd' % (self._id,self.basename)
-        append = os.path.isfile(dcdfilename)
-        if append:
-            mode = 'r+b'
-        else:
-            mode = 'wb'
-        self.dcdfile = open(dcdfilename, mode)
-        self.dcd = DCDFile(self.dcdfile, self.worker.topology, self.ommsystem.MDstepsize, append=append)
-        self.dcdfile.flush() # Force the writing of the DCD header
+        self.trajectory_writer = trajectory_writer
+        self.trajectory_writer.open(self._id, dcdfilename)
 
     def save_dcd(self):
-        #TODO
-        #boxsize options works only for NVT because the boxsize of the service worker
-        #is not updated from the compute worker
-        boxsize = self.worker.simulation.context.getState().getPeriodicBoxVectors()
-        self.dcd.writeModel(self.positions, periodicBoxVectors=boxsize)
+        self.trajectory_writer.submit(self._id, self._positions, self.boxvectors)
+
+    def set_boxvectors(self, boxvectors):
+        self.boxvectors = boxvectors
 
     def set_mdsteps(self, mdsteps):
         self.mdsteps = mdsteps
@@ -118,10 +251,24 @@ class OMMReplica(object):
 class OMMReplicaTRE(OMMReplica):
     def save_out(self):
         if self.pot is not None and self.par is not None:
-            pot_energy = self.pot['potential_energy']
-            temperature = self.par['temperature']
-            if self.outfile is not None:
-                self.outfile.write("%d %f %f\n" % (self.stateid, temperature, pot_energy))
+            self.sample_log.append(replica = self._id, cycle = self.cycle, stateid = self.stateid,
+                                   temperature = self.par['temperature']/kelvin,
+                                   potE = self.pot['potential_energy']/kilocalories_per_mole)
+
+    def checkpoint_arrays(self):
+        arrays = super().checkpoint_arrays()
+        if self.par is not None:
+            arrays['par'] = np.array([self.par['temperature']/kelvin])
+        if self.pot is not None:
+            arrays['pot'] = np.array([self.pot['potential_energy']/kilojoules_per_mole])
+        return arrays
+
+    def update_state_from_arrays(self, arrays):
+        super().update_state_from_arrays(arrays)
+        if 'par' in arrays:
+            self.par = {'temperature': float(arrays['par'][0])*kelvin}
+        if 'pot' in arrays:
+            self.pot = {'potential_energy': float(arrays['pot'][0])*kilojoules_per_mole}
 
     def update_state_from_context(self):
         self.cycle = int(self.context.getParameter(self.ommsystem.parameter['cycle']))
@@ -134,8 +281,8 @@ class OMMReplicaTRE(OMMReplica):
             self.pot = {}
         self.pot['potential_energy'] = self.context.getParameter(self.ommsystem.parameter['potential_energy'])*kilojoules_per_mole
         state = self.context.getState(getPositions=True, getVelocities=True)
-        self.positions = state.getPositions()
-        self.velocities = state.getVelocities()
+        self.positions = state.getPositions(asNumpy=True)
+        self.velocities = state.getVelocities(asNumpy=True)
 
     def update_context_from_state(self):
         self.context.setParameter(self.ommsystem.parameter['cycle'], self.cycle)
@@ -149,24 +296,57 @@ class OMMReplicaTRE(OMMReplica):
 class OMMReplicaATM(OMMReplica):
     def save_out(self):
         if self.pot is not None and self.par is not None:
-            pot_energy = self.pot['potential_energy']
-            pert_energy = self.pot['perturbation_energy']
-            bias_energy = self.pot['bias_energy']
-            temperature = self.par['temperature']
-            lmbd1 = self.par['lambda1']
-            lmbd2 = self.par['lambda2']
-            alpha = self.par['alpha']
-            u0 = self.par['u0']
-            w0 = self.par['w0']
-            direction = self.par['atmdirection']
-            if self.outfile is not None:
-                self.outfile.write("%d %f %f %f %f %f %f %f %f %f %f\n" % (self.stateid, temperature/kelvin, direction, lmbd1, lmbd2, alpha*kilocalories_per_mole, u0/kilocalories_per_mole, w0/kilocalories_per_mole, pot_energy/kilocalories_per_mole, pert_energy/kilocalories_per_mole, bias_energy/kilocalories_per_mole))
-                self.outfile.flush()
-            else:
-                self.logger.warning("unable to save output")
+            self.sample_log.append(replica = self._id, cycle = self.cycle, stateid = self.stateid,
+                                   temperature = self.par['temperature']/kelvin,
+                                   direction = self.par['atmdirection'],
+                                   lambda1 = self.par['lambda1'],
+                                   lambda2 = self.par['lambda2'],
+                                   alpha = self.par['alpha']*kilocalories_per_mole,
+                                   u0 = self.par['u0']/kilocalories_per_mole,
+                                   w0 = self.par['w0']/kilocalories_per_mole,
+                                   potE = self.pot['potential_energy']/kilocalories_per_mole,
+                                   pertE = self.pot['perturbation_energy']/kilocalories_per_mole,
+                                   biasE = self.pot['bias_energy']/kilocalories_per_mole)
         else:
             self.logger.warning("unable to save output")
 
+    def checkpoint_arrays(self):
+        arrays = super().checkpoint_arrays()
+        if self.par is not None:
+            arrays['par'] = np.array([self.par['temperature']/kelvin,
+                                      self.par['lambda1'],
+                                      self.par['lambda2'],
+                                      self.par['alpha']*kilojoules_per_mole,
+                                      self.par['u0']/kilojoules_per_mole,
+                                      self.par['w0']/kilojoules_per_mole,
+                                      self.par['atmdirection'],
+                                      self.par['atmintermediate']])
+        if self.pot is not None:
+            arrays['pot'] = np.array([self.pot['potential_energy']/kilojoules_per_mole,
+                                      self.pot['perturbation_energy']/kilojoules_per_mole,
+                                      self.pot['bias_energy']/kilojoules_per_mole])
+        return arrays
+
+    def update_state_from_arrays(self, arrays):
+        super().update_state_from_arrays(arrays)
+        if 'par' in arrays:
+            par = [float(v) for v in arrays['par']]
+            self.par = {}
+            self.par['temperature'] = par[0]*kelvin
+            self.par['lambda1'] = par[1]
+            self.par['lambda2'] = par[2]
+            self.par['alpha'] = par[3]/kilojoules_per_mole
+            self.par['u0'] = par[4]*kilojoules_per_mole
+            self.par['w0'] = par[5]*kilojoules_per_mole
+            self.par['atmdirection'] = par[6]
+            self.par['atmintermediate'] = par[7]
+        if 'pot' in arrays:
+            pot = [float(v) for v in arrays['pot']]
+            self.pot = {}
+            self.pot['potential_energy'] = pot[0]*kilojoules_per_mole
+            self.pot['perturbation_energy'] = pot[1]*kilojoules_per_mole
+            self.pot['bias_energy'] = pot[2]*kilojoules_per_mole
+
     def update_state_from_context(self):
         self.cycle = int(self.context.getParameter(self.ommsystem.parameter['cycle']))
         self.stateid = int(self.context.getParameter(self.ommsystem.parameter['stateid']))
@@ -187,8 +367,8 @@ class OMMReplicaATM(OMMReplica):
         self.pot['perturbation_energy'] = self.context.getParameter(self.ommsystem.parameter['perturbation_energy'])*kilojoules_per_mole
         self.pot['bias_energy'] = self.context.getParameter(self.ommsystem.parameter['bias_energy'])*kilojoules_per_mole
         state = self.context.getState(getPositions=True, getVelocities=True)
-        self.positions = state.getPositions()
-        self.velocities = state.getVelocities()
+        self.positions = state.getPositions(asNumpy=True)
+        self.velocities = state.getVelocities(asNumpy=True)
 
     def update_context_from_state(self):
         self.context.setParameter(self.ommsystem.parameter['cycle'], self.cycle)
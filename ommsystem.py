@@ -4,6 +4,7 @@ from __future__ import division
 Collects all of the ways that openmm systems are loaded
 """
 import os, re, sys, time, shutil, copy, random, signal
+import hashlib, pickle
 import numpy as np
 import multiprocessing as mp
 #from multiprocessing import Process, Queue, Event
@@ -18,6 +19,32 @@ from configobj import ConfigObj
 
 from atmmetaforce import *
 
+def _as_array(x, unit):
+    #positions/velocities as a (natoms,3) float64 array in the given units
+    if is_quantity(x):
+        x = x.value_in_unit(unit)
+    return np.asarray(x, dtype=np.float64)
+
+#control file keywords that determine the System, see OMMSystem.system_cache_key()
+SYSTEM_KEYWORDS = ('HMASS', 'TIME_STEP', 'FRICTION_COEFF', 'UMAX', 'UBCORE', 'ACORE', 'DISPLACEMENT',
+                   'LIGOFFSET', 'LIGAND_ATOMS', 'LIGAND1_ATOMS', 'LIGAND2_ATOMS',
+                   'LIGAND_CM_ATOMS', 'LIGAND1_CM_ATOMS', 'LIGAND2_CM_ATOMS', 'RCPT_CM_ATOMS',
+                   'REST_LIGAND_CMREC_ATOMS', 'CM_KF', 'CM_TOL',
+                   'LIGAND_VSITE_FRAMEGROUPS', 'LIGAND1_VSITE_FRAMEGROUPS', 'LIGAND2_VSITE_FRAMEGROUPS',
+                   'RCPT_VSITE_FRAMEGROUPS',
+                   'VSITE_KFTHETA', 'VSITE_THETA0', 'VSITE_THETATOL',
+                   'VSITE_KFPHI', 'VSITE_PHI0', 'VSITE_PHITOL',
+                   'VSITE_KFPSI', 'VSITE_PSI0', 'VSITE_PSITOL',
+                   'VSITE_KFTHETA_LIG1', 'VSITE_THETA0_LIG1', 'VSITE_THETATOL_LIG1',
+                   'VSITE_KFPHI_LIG1', 'VSITE_PHI0_LIG1', 'VSITE_PHITOL_LIG1',
+                   'VSITE_KFPSI_LIG1', 'VSITE_PSI0_LIG1', 'VSITE_PSITOL_LIG1',
+                   'VSITE_KFTHETA_LIG2', 'VSITE_THETA0_LIG2', 'VSITE_THETATOL_LIG2',
+                   'VSITE_KFPHI_LIG2', 'VSITE_PHI0_LIG2', 'VSITE_PHITOL_LIG2',
+                   'VSITE_KFPSI_LIG2', 'VSITE_PSI0_LIG2', 'VSITE_PSITOL_LIG2',
+                   'ALIGN_LIGAND1_REF_ATOMS', 'ALIGN_LIGAND2_REF_ATOMS',
+                   'ALIGN_KF_SEP', 'ALIGN_K_THETA', 'ALIGN_K_PSI',
+                   'POS_RESTRAINED_ATOMS', 'POSRE_FORCE_CONSTANT', 'POSRE_TOLERANCE')
+
 # OpenMM's MTSLangevinIntegrator does not have a setTemperature method
 class ATMMTSLangevinIntegrator(MTSLangevinIntegrator):
     def setTemperature(self, temperature):
@@ -54,6 +81,82 @@ class OMMSystem(object):
 
         self.doMetaD = False
 
+        #serialized System set by the master, see build_system()
+        self.system_data = None
+
+    #attributes set by create_system() that are restored together with the System
+    _cached_attributes = ('topology', 'positions', 'boxvectors', 'cparams', 'doMetaD')
+
+    def build_system(self):
+        """
+        Sets up the System, from system_data if set by the master, otherwise
+        from the on-disk cache if available, otherwise by create_system(),
+        in which case the cache is written for later runs.
+        """
+        if self.system_data is not None:
+            self.load_system_data(self.system_data)
+            return
+        cachefile = self.system_cache_file()
+        if cachefile is not None and os.path.isfile(cachefile):
+            try:
+                with open(cachefile, 'rb') as f:
+                    self.load_system_data(pickle.load(f))
+                self.logger.info("Loaded System from %s" % cachefile)
+                return
+            except Exception as e:
+                self.logger.warning("unable to load System from %s (%s), rebuilding it" % (cachefile, e))
+        self.create_system()
+        if cachefile is not None:
+            try:
+                tmpfile = cachefile + '.tmp'
+                with open(tmpfile, 'wb') as f:
+                    pickle.dump(self.system_data_of(), f, protocol = pickle.HIGHEST_PROTOCOL)
+                os.replace(tmpfile, cachefile)
+            except Exception as e:
+                self.logger.warning("unable to write System cache %s (%s)" % (cachefile, e))
+
+    def system_data_of(self):
+        #picklable serialized form of the System built by create_system()
+        data = {name: getattr(self, name) for name in self._cached_attributes}
+        data['system'] = XmlSerializer.serialize(self.system)
+        return data
+
+    def load_system_data(self, data):
+        for name in self._cached_attributes:
+            setattr(self, name, data[name])
+        self.system = XmlSerializer.deserialize(data['system'])
+        self._restore_forces()
+        #the integrator is not serialized, it is cheap to rebuild
+        self.set_integrator(300 * kelvin, self.frictionCoeff, self.MDstepsize)
+
+    def _restore_forces(self):
+        #recovers references to the forces of a deserialized System
+        pass
+
+    def system_cache_files(self):
+        #input files that determine the System
+        return []
+
+    def system_cache_key(self):
+        key = hashlib.sha256()
+        key.update(type(self).__name__.encode())
+        for filename in self.system_cache_files():
+            with open(filename, 'rb') as f:
+                key.update(f.read())
+        for name in SYSTEM_KEYWORDS:
+            key.update(("%s=%s;" % (name, self.keywords.get(name))).encode())
+        return key.hexdigest()
+
+    def system_cache_file(self):
+        #None if caching is disabled (SYSTEM_CACHE = no) or not possible, as with metadynamics
+        #biases which depend on external files
+        cache = self.keywords.get('SYSTEM_CACHE')
+        if cache is not None and cache.lower() == 'no':
+            return None
+        if self.keywords.get('METADBIAS_DIR') is not None:
+            return None
+        return "%s_system_%s.pkl" % (self.basename, self.system_cache_key()[:16])
+
     def _exit(message):
         """Print and flush a message to stdout and then exit."""
         self.logger.error(message)
@@ -68,6 +171,9 @@ class OMMSystemAmber(OMMSystem):
         self.parameter['temperature'] = 'RETemperature'
         self.parameter['potential_energy'] = 'REPotEnergy'
 
+    def system_cache_files(self):
+        return [self.prmtopfile, self.crdfile]
+
     def load_amber_system(self):
         """
         sets the value of
@@ -200,9 +306,15 @@ class OMMSystemAmberABFE(OMMSystemAmber):
         self.parameter['atmintermediate'] = 'REAlchemicalIntermediate'
         self.parameter['bias_energy'] = 'BiasEnergy'
         self.atmforce = None
+        self.atmforce_index = None
         self.lig_atoms = None
         self.displ = None
 
+    _cached_attributes = OMMSystemAmber._cached_attributes + ('lig_atoms', 'displ', 'atmforce_index')
+
+    def _restore_forces(self):
+        self.atmforce = ATMMetaForce.cast(self.system.getForce(self.atmforce_index))
+
     def set_ligand_atoms(self):
         lig_atoms_in = self.keywords.get('LIGAND_ATOMS')   #indexes of ligand atoms
         if lig_atoms_in is not None:
@@ -325,7 +437,7 @@ class OMMSystemAmberABFE(OMMSystemAmber):
         for i in self.lig_atoms:
             self.atmforce.setParticleParameters(i, i, self.displ[0], self.displ[1], self.displ[2] )
         self.atmforce.setForceGroup(self.atmforcegroup)
-        self.system.addForce(self.atmforce)
+        self.atmforce_index = self.system.addForce(self.atmforce)
         #these are the global parameters specified in the cntl files that need to be reset
         #by the worker after reading the first configuration
         self.cparams["ATMUmax"] = umsc/kilojoules_per_mole
@@ -371,10 +483,16 @@ class OMMSystemAmberRBFE(OMMSystemAmber):
         self.parameter['atmintermediate'] = 'REAlchemicalIntermediate'
         self.parameter['bias_energy'] = 'BiasEnergy'
         self.atmforce = None
+        self.atmforce_index = None
         self.lig1_atoms = None
         self.lig2_atoms = None
         self.displ = None
 
+    _cached_attributes = OMMSystemAmber._cached_attributes + ('lig1_atoms', 'lig2_atoms', 'displ', 'atmforce_index')
+
+    def _restore_forces(self):
+        self.atmforce = ATMMetaForce.cast(self.system.getForce(self.atmforce_index))
+
     def set_ligand_atoms(self):
         lig1_atoms_in = self.keywords.get('LIGAND1_ATOMS')   #indexes of ligand1 atoms
         lig2_atoms_in = self.keywords.get('LIGAND2_ATOMS')   #indexes of ligand2 atoms
@@ -583,7 +701,7 @@ class OMMSystemAmberRBFE(OMMSystemAmber):
             self.atmforce.setParticleParameters(i, i, -self.displ[0], -self.displ[1], -self.displ[2] )
 
         self.atmforce.setForceGroup(self.atmforcegroup)
-        self.system.addForce(self.atmforce)
+        self.atmforce_index = self.system.addForce(self.atmforce)
 
         #these are the global parameters specified in the cntl files that need to be reset after reading the first configuration
         self.cparams["ATMUmax"] = umsc/kilojoules_per_mole
@@ -4,7 +4,9 @@ from __future__ import division
 Multiprocessing job transport for AsyncRE/OpenMM
 """
 import os, re, sys, time, shutil, copy, random, signal
+import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory
 #from multiprocessing import Process, Queue, Event
 import logging
 
@@ -16,9 +18,123 @@ from datetime import datetime
 
 from ommreplica import *
 from ommsystem import *
+from ommsystem import _as_array
 
 from contextlib import contextmanager
 
+#number of coordinate buffers in the shared-memory ring of each worker
+POSVEL_RING_SLOTS = 2
+
+#modules imported once by the forkserver from which the compute workers are forked
+WORKER_PRELOAD_MODULES = ['__main__', 'simtk.openmm', 'simtk.openmm.app', 'ommworker']
+
+_forkserver_started = False
+
+def worker_context(start_method = 'forkserver'):
+    """
+    Returns the multiprocessing context used to start the compute workers.
+
+    With the forkserver start method the workers are forked from a server
+    process that has already imported OpenMM and the AsyncRE modules, rather
+    than re-importing them in every new process as with spawn. The server is
+    started with SIGINT ignored, a disposition inherited by the workers forked
+    from it, so that as with spawn the workers do not respond to ctrl-c.
+    Falls back to spawn where forkserver is not available.
+    """
+    global _forkserver_started
+    if start_method not in mp.get_all_start_methods():
+        start_method = 'spawn'
+    ctx = mp.get_context(start_method)
+    if start_method == 'forkserver' and not _forkserver_started:
+        from multiprocessing import forkserver
+        ctx.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+        s = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            forkserver.ensure_running()
+        finally:
+            signal.signal(signal.SIGINT, s)
+        _forkserver_started = True
+    return ctx
+
+def start_workers(workers, logger = None):
+    """
+    Starts the compute workers concurrently: all of the worker processes are
+    spawned before waiting for any of them to build its context. Logs the
+    startup time of each worker and returns the workers that started. A worker
+    that dies or is not ready within its start timeout is left out.
+    """
+    if logger is None:
+        logger = logging.getLogger("async_re.ommworker")
+    start_time = time.time()
+    for worker in workers:
+        worker.launch_worker()
+    started = []
+    for worker in workers:
+        if worker.wait_worker() is None:
+            logger.warning("worker %s failed to start, it will not be used" % worker.name())
+        else:
+            logger.info("worker %s ready in %.1f s (launch %.2f s, context %.1f s)" %
+                        (worker.name(), worker.startup_time, worker.launch_overhead,
+                         worker.startup_time - worker.launch_overhead))
+            started.append(worker)
+    logger.info("%d of %d workers started in %.1f s" % (len(started), len(workers), time.time() - start_time))
+    if started:
+        #the launch overhead is the time spent by the workers before building their contexts
+        launch_time = sum(worker.launch_overhead for worker in started)/len(started)
+        logger.info("average worker launch overhead (%s): %.2f s" % (started[0].start_method, launch_time))
+    return started
+
+def split_worker(worker, nworkers, completion_queue = None):
+    """
+    Returns nworkers unstarted copies of a worker sharing its device, with the
+    threads of the device divided among them
+    """
+    nthreads = int(worker.node_info["threads_number"])
+    workers = []
+    for k in range(nworkers):
+        node = dict(worker.node_info)
+        node["threads_number"] = str(max(1, nthreads//nworkers + (1 if k < nthreads % nworkers else 0)))
+        node["worker_index"] = k
+        workers.append(type(worker)(worker.basename, worker.ommsystem, worker.keywords, node_info = node,
+                                    compute = True, logger = worker.logger,
+                                    completion_queue = completion_queue, start = False))
+    return workers
+
+def calibrate_workers_per_device(worker, nsteps = 1000, logger = None):
+    """
+    Measures the aggregate MD throughput (ns/day) on the device of a worker
+    when it is split among 1, 2, 4, ... workers, up to one thread per worker.
+    All of the workers of a split run nsteps concurrently after a short
+    warm-up run. Returns the best number of workers per device and a
+    dictionary of the throughput of each split.
+    """
+    if logger is None:
+        logger = logging.getLogger("async_re.ommworker")
+    nthreads = int(worker.node_info["threads_number"])
+    dt = worker.ommsystem.MDstepsize/nanosecond
+    throughput = {}
+    nworkers = 1
+    while nworkers <= nthreads:
+        workers = start_workers(split_worker(worker, nworkers), logger)
+        if len(workers) == nworkers:
+            for nrun in (max(1, nsteps//10), nsteps):
+                start_time = time.time()
+                for w in workers:
+                    w.run(nrun)
+                while not all(w.is_done() or w.has_crashed() for w in workers):
+                    time.sleep(0.1)
+                elapsed = time.time() - start_time
+            if not any(w.has_crashed() for w in workers):
+                throughput[nworkers] = nworkers*nsteps*dt*86400.0/elapsed
+                logger.info("calibration: %d workers x %d threads on %s: %.1f ns/day" %
+                            (nworkers, nthreads//nworkers, worker.name(), throughput[nworkers]))
+        for w in workers:
+            w.finish()
+        nworkers *= 2
+    if not throughput:
+        return (1, throughput)
+    return (max(throughput, key = throughput.get), throughput)
+
 class OMMWorker(object):
     # OpenMM worker to run a replica in a process controlling one device
     #
@@ -26,15 +142,17 @@ class OMMWorker(object):
     # See bedamtempt for an example
     #  set_state_values()
     #  get_energy_values()
-    #  _worker_setstate_fromqueue()
-    #  _worker_getenergy()
+    #  _worker_setstate()
+    #  _worker_energy()
     #  _openmm_worker_body()
-    def __init__(self, basename, ommsystem, keywords, node_info = None, compute = True, logger = None):
+    def __init__(self, basename, ommsystem, keywords, node_info = None, compute = True, logger = None, completion_queue = None, start = True):
         self.node_name = None
         self.platform_name = None
         self.platformId = None
         self.deviceId = None
         self.nthreads = None
+        self.workerIndex = None
+        self.node_info = node_info
         if node_info is not None:
             self.node_name = node_info['node_name']
             pattern = re.compile('(\d+):(\d+)')
@@ -42,16 +160,59 @@ class OMMWorker(object):
             matches = pattern.search(node_info["slot_number"])
             self.platformId = int(matches.group(1))
             self.deviceId = int(matches.group(2))
-            self.nthreads = int(node_info["threads_number"])        
+            self.nthreads = int(node_info["threads_number"])
+            #index of the worker among those sharing the device, see split_worker()
+            self.workerIndex = node_info.get("worker_index")
         self.basename = basename
         self.keywords = keywords
         self.ommsystem = ommsystem
         self.compute = compute
         self.logger = logger
-        self.start_worker()
-
-    def start_worker(self):
-        self.ctx =  mp.get_context('spawn')
+        #queue shared by all of the workers to notify the master of completed runs
+        self.completion_queue = completion_queue
+        #shared-memory ring of (positions, velocities) buffers, see _make_posvel_ring()
+        self._shm = None
+        self._posvel = None
+        self._slot = 0
+        #latency counters of run_cycle()/get_cycle_result(), in seconds
+        self.ncycles = 0
+        self.dispatch_time = 0.0
+        self.md_time = 0.0
+        self.reply_time = 0.0
+        self.last_md_time = None
+        self._send_time = None
+        #seconds to wait for a compute worker to build its context, WORKER_START_TIMEOUT
+        self.start_timeout = float(keywords.get('WORKER_START_TIMEOUT')) if keywords.get('WORKER_START_TIMEOUT') is not None else 600.0
+        #WORKER_START_METHOD: forkserver (default) or spawn, see worker_context()
+        self.start_method = keywords.get('WORKER_START_METHOD') if keywords.get('WORKER_START_METHOD') is not None else 'forkserver'
+        self.launch_time = None
+        self.launch_overhead = None
+        self.startup_time = None
+        #with start = False the worker is started later by launch_worker()/wait_worker(),
+        #see start_workers()
+        if start:
+            self.start_worker()
+
+    def name(self):
+        if self.node_name is None:
+            return "service"
+        name = "%s:%s:%d:%d" % (self.node_name, self.platform_name, self.platformId, self.deviceId)
+        if self.workerIndex is not None:
+            name += "/%d" % self.workerIndex
+        return name
+
+    # starts the worker and waits until it is ready, returns None if it fails to start
+    def start_worker(self, timeout = None):
+        self.launch_worker()
+        if self.compute:
+            return self.wait_worker(timeout)
+        return 1
+
+    # spawns the worker process without waiting for it to build its context
+    def launch_worker(self):
+        #the ring of a previous (crashed) instance of the worker is not reused
+        self._release_posvel_ring()
+        self.ctx = worker_context(self.start_method) if self.compute else mp.get_context('spawn')
         self._startedSignal = self.ctx.Event()
         self._startedSignal.clear()
         self._readySignal = self.ctx.Event()
@@ -80,17 +241,42 @@ class OMMWorker(object):
         if self.compute:
             #compute workers are launched as subprocesses
             s = signal.signal(signal.SIGINT, signal.SIG_IGN) #so that children do not respond to ctrl-c
-            self._p = self.ctx.Process(target=self.openmm_worker, args=(self._startedSignal,self._readySignal,self._runningSignal,self._errorSignal,self._isDone,self._cmdq,self._inq,self._outq))
+            self._p = self.ctx.Process(target=self.openmm_worker, args=(self._startedSignal,self._readySignal,self._runningSignal,self._errorSignal,self._isDone,self._cmdq,self._inq,self._outq,self.completion_queue))
             self._p.daemon = True
             signal.signal(signal.SIGINT, s) #restore signal before start() of children
+            self.launch_time = time.time()
             self._p.start()
-            self._readySignal.wait()
-            return self._p
         else:
             #the service worker needs only the context in this process
             self._openmm_worker_body()
             self._openmm_worker_makecontext()
-            return 1
+
+    # waits for a worker spawned by launch_worker() to be ready. Returns None, after
+    # terminating the process, if the worker dies or is not ready within timeout seconds
+    def wait_worker(self, timeout = None):
+        if timeout is None:
+            timeout = self.start_timeout
+        deadline = self.launch_time + timeout
+        while not self._readySignal.wait(0.5):
+            if self.has_crashed():
+                self.logger.error("worker %s has crashed while starting" % self.name())
+                self._abort_worker()
+                return None
+            if time.time() > deadline:
+                self.logger.error("worker %s was not ready after %.1f s" % (self.name(), timeout))
+                self._abort_worker()
+                return None
+        #the worker reports the number of atoms and the time it started to build its context
+        (self.natoms, body_time) = self._outq.get()
+        self._make_posvel_ring()
+        self.startup_time = time.time() - self.launch_time
+        self.launch_overhead = body_time - self.launch_time
+        return self._p
+
+    def _abort_worker(self):
+        self._p.terminate()
+        self._p.join(10)
+        self._errorSignal.set()
 
     def set_state(self, par):
         self._readySignal.wait()
@@ -104,23 +290,112 @@ class OMMWorker(object):
         pot = self._outq.get()
         return pot
 
+    # creates the shared-memory ring through which positions and velocities
+    # are exchanged with the worker process. Only the slot index travels
+    # through the queues.
+    def _make_posvel_ring(self):
+        shape = (POSVEL_RING_SLOTS, 2, self.natoms, 3)
+        self._shm = shared_memory.SharedMemory(create = True, size = int(np.prod(shape))*8)
+        self._posvel = np.ndarray(shape, dtype = np.float64, buffer = self._shm.buf)
+        self._slot = 0
+        self._cmdq.put("SETSHM")
+        self._inq.put((self._shm.name, self.natoms, POSVEL_RING_SLOTS))
+
+    def _release_posvel_ring(self):
+        self._posvel = None
+        self.positions = None
+        self.velocities = None
+        if self._shm is not None:
+            try:
+                self._shm.unlink()
+            except OSError:
+                pass
+            try:
+                self._shm.close()
+            except BufferError:
+                #views of the ring are still referenced, the mapping goes away with them
+                pass
+            self._shm = None
+
+    def _next_slot(self):
+        self._slot = (self._slot + 1) % POSVEL_RING_SLOTS
+        return self._slot
+
     # set positions and velocities of worker
     def set_posvel(self, positions, velocities):
         self._startedSignal.wait()
         self._readySignal.wait()
+        slot = self._next_slot()
+        self._posvel[slot,0] = _as_array(positions, nanometer)
+        self._posvel[slot,1] = _as_array(velocities, nanometer/picosecond)
         self._cmdq.put("SETPOSVEL")
-        self._inq.put(positions)
-        self._inq.put(velocities)
+        self._inq.put(slot)
 
     # get positions and velocities from worker
+    # these are views of the shared-memory ring valid until the slot is reused
     def get_posvel(self):
         self._startedSignal.wait()
         self._readySignal.wait()
         self._cmdq.put("GETPOSVEL")
-        self.positions = self._outq.get()
-        self.velocities = self._outq.get()
+        self._inq.put(self._next_slot())
+        slot = self._outq.get()
+        self.positions = Quantity(self._posvel[slot,0], nanometer)
+        self.velocities = Quantity(self._posvel[slot,1], nanometer/picosecond)
         return (self.positions, self.velocities)
 
+    # launches a cycle of a replica with one message carrying the thermodynamic
+    # state, the coordinates (through the shared-memory ring) and the step
+    # counts. The reply is collected by get_cycle_result().
+    # tag is posted to the completion queue, if any, when the cycle is done
+    def run_cycle(self, par, positions, velocities, nsteps, nheating = 0, ncooling = 0, hightemp = 0.0, tag = None, boxvectors = None):
+        self._startedSignal.wait()
+        self._readySignal.wait()
+        #positions = None keeps the coordinates currently in the worker's context
+        slot_in = None
+        box = None
+        if positions is not None:
+            slot_in = self._next_slot()
+            self._posvel[slot_in,0] = _as_array(positions, nanometer)
+            self._posvel[slot_in,1] = _as_array(velocities, nanometer/picosecond)
+            if boxvectors is not None:
+                box = _as_array(boxvectors, nanometer)
+        slot_out = self._next_slot()
+        self._isDone.clear()
+        self._runningSignal.set()
+        self._send_time = time.time()
+        self._cmdq.put(("RUNCYCLE", {'par': par, 'slot_in': slot_in, 'slot_out': slot_out,
+                                     'nsteps': nsteps, 'nheating': nheating, 'ncooling': ncooling,
+                                     'hightemp': hightemp, 'tag': tag, 'box': box}))
+
+    # returns the (positions, velocities, energies) at the end of the cycle launched
+    # by run_cycle(), (None, None, None) if MD failed. Positions and velocities
+    # are views of the shared-memory ring valid until the slot is reused.
+    # The periodic box vectors at the end of the cycle are left in self.boxvectors
+    def get_cycle_result(self):
+        self._startedSignal.wait()
+        reply = self._outq.get()
+        harvest_time = time.time()
+        if reply['pot'] is None:
+            return (None, None, None)
+        self.ncycles += 1
+        self.dispatch_time += reply['start_time'] - self._send_time
+        self.last_md_time = reply['end_time'] - reply['start_time']
+        self.md_time += self.last_md_time
+        self.reply_time += harvest_time - reply['end_time']
+        slot = reply['slot']
+        self.positions = Quantity(self._posvel[slot,0], nanometer)
+        self.velocities = Quantity(self._posvel[slot,1], nanometer/picosecond)
+        self.boxvectors = Quantity(reply['box'], nanometer)
+        return (self.positions, self.velocities, reply['pot'])
+
+    # average MD time and dispatch and reply latencies per cycle, None if no cycles yet
+    def cycle_timings(self):
+        if self.ncycles == 0:
+            return None
+        return {'md': self.md_time/self.ncycles,
+                'dispatch': self.dispatch_time/self.ncycles,
+                'reply': self.reply_time/self.ncycles}
+
     # sets the reporters of the worker
     def set_reporters(self, current_steps, outfile, logfile, dcdfile):
         self._startedSignal.wait()
@@ -142,6 +417,7 @@ class OMMWorker(object):
         self._p.terminate()
         self._p.join(10) #10s time-out
         self._p.exitcode
+        self._release_posvel_ring()
 
     # is worker running?
     def is_running(self):
@@ -160,7 +436,8 @@ class OMMWorker(object):
         return not self._p.is_alive() or self._errorSignal.is_set()
 
     # starts execution loop of the worker
-    def run(self, nsteps, nheating = 0, ncooling = 0, hightemp = 0.0):
+    # tag is posted to the completion queue, if any, when the run is done
+    def run(self, nsteps, nheating = 0, ncooling = 0, hightemp = 0.0, tag = None):
         self._startedSignal.wait()
         self._readySignal.wait()
         self._cmdq.put("RUN")
@@ -168,6 +445,7 @@ class OMMWorker(object):
         self._inq.put(nheating)
         self._inq.put(ncooling)
         self._inq.put(hightemp)
+        self._inq.put(tag)
         self._runningSignal.set()
         self._isDone.clear()
 
@@ -178,7 +456,7 @@ class OMMWorker(object):
 
     def _openmm_worker_body(self):
         
-        self.ommsystem.create_system()
+        self.ommsystem.build_system()
         self.system = self.ommsystem.system
         self.topology = self.ommsystem.topology
         self.integrator = self.ommsystem.integrator
@@ -253,13 +531,15 @@ class OMMWorker(object):
         if self.compute and self.platformId is not None and self.deviceId is not None:
             #sets up logfile
             self.wdir = "cntxt_%s_%d_%d" % (self.node_name,int(self.platformId),int(self.deviceId))
+            if self.workerIndex is not None:
+                self.wdir += "_%d" % self.workerIndex
             if not os.path.isdir(self.wdir):
                 os.mkdir(self.wdir)
             self.logfile = "%s/%s.log" % (self.wdir, self.basename)
             self.logfile_p = open(self.logfile, 'a+')
             self.simulation.reporters.append(StateDataReporter(self.logfile_p, self.nprnt, step=True, temperature=True))
 
-    def openmm_worker(self, startedSignal, readySignal, runningSignal, errorSignal, isDone, cmdq, inq, outq):
+    def openmm_worker(self, startedSignal, readySignal, runningSignal, errorSignal, isDone, cmdq, inq, outq, completionq = None):
         try:
             import setproctitle
             setproctitle.setproctitle("AToM worker")
@@ -272,26 +552,77 @@ class OMMWorker(object):
         errorSignal.clear()
         isDone.clear()
 
+        body_time = time.time()
         self._openmm_worker_body()
         self._openmm_worker_makecontext()
         
         self.positions = None
         self.velocities = None
+        shm = None
 
         #start event loop
+        outq.put((self.topology.getNumAtoms(), body_time))
         startedSignal.set()
         readySignal.set()
         while(True):
             readySignal.set()
-            while(cmdq.empty()):
-                time.sleep(0.1)
-            command = cmdq.get()
+            #blocks until the next message, either a command or a (command, payload) tuple
+            message = cmdq.get()
             readySignal.clear()
-            if command == "SETSTATE":
+            if isinstance(message, tuple):
+                (command, payload) = message
+            else:
+                command = message
+                payload = None
+            if command == "RUNCYCLE":
+                runningSignal.set()
+                self._worker_setstate(payload['par'])
+                if payload['slot_in'] is not None:
+                    if payload['box'] is not None:
+                        self.context.setPeriodicBoxVectors(*[Vec3(*v) for v in payload['box']])
+                    self.positions = posvel[payload['slot_in'],0]
+                    self.velocities = posvel[payload['slot_in'],1]
+                    self.context.setPositions(self.positions)
+                    self.context.setVelocities(self.velocities)
+                self.nsteps = int(payload['nsteps'])
+                self.nheating = int(payload['nheating'])
+                self.ncooling = int(payload['ncooling'])
+                self.hightemp = float(payload['hightemp'])
+
+                start_time = time.time()
+                res = self._openmm_worker_run()
+                end_time = time.time()
+
+                if self.logfile_p is not None:
+                    self.logfile_p.flush()
+
+                reply = {'slot': payload['slot_out'], 'pot': None,
+                         'start_time': start_time, 'end_time': end_time}
+                if res is None:
+                    errorSignal.set()
+                else:
+                    slot = payload['slot_out']
+                    state = self.context.getState(getPositions=True, getVelocities=True)
+                    posvel[slot,0] = state.getPositions(asNumpy=True).value_in_unit(nanometer)
+                    posvel[slot,1] = state.getVelocities(asNumpy=True).value_in_unit(nanometer/picosecond)
+                    reply['box'] = state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(nanometer)
+                    reply['pot'] = self._worker_energy()
+                outq.put(reply)
+
+                isDone.set()
+                #wakes up the master
+                if completionq is not None:
+                    completionq.put((payload['tag'], time.time()))
+            elif command == "SETSTATE":
                 self._worker_setstate_fromqueue()
+            elif command == "SETSHM":
+                (name, natoms, nslots) = inq.get()
+                shm = shared_memory.SharedMemory(name = name)
+                posvel = np.ndarray((nslots, 2, natoms, 3), dtype = np.float64, buffer = shm.buf)
             elif command == "SETPOSVEL":
-                self.positions = inq.get()
-                self.velocities = inq.get()
+                slot = inq.get()
+                self.positions = posvel[slot,0]
+                self.velocities = posvel[slot,1]
                 self.context.setPositions(self.positions)
                 self.context.setVelocities(self.velocities)
             elif command == "RUN":
@@ -302,6 +633,7 @@ class OMMWorker(object):
                 self.nheating = int(inq.get())
                 self.ncooling = int(inq.get())
                 self.hightemp = float(inq.get())
+                tag = inq.get()
 
                 res = self._openmm_worker_run()
 
@@ -312,17 +644,25 @@ class OMMWorker(object):
                     errorSignal.set()
 
                 isDone.set()
+                #wakes up the master
+                if completionq is not None:
+                    completionq.put((tag, time.time()))
             elif command == "GETENERGY":
                 pot = self._worker_getenergy()
             elif command == "GETPOSVEL":
+                slot = inq.get()
                 state = self.context.getState(getPositions=True, getVelocities=True)
-                self.positions = state.getPositions()
-                self.velocities = state.getVelocities()
-                outq.put(self.positions)
-                outq.put(self.velocities)
+                posvel[slot,0] = state.getPositions(asNumpy=True).value_in_unit(nanometer)
+                posvel[slot,1] = state.getVelocities(asNumpy=True).value_in_unit(nanometer/picosecond)
+                outq.put(slot)
             elif command == "FINISH":
                 if self.outfile_p is not None:
                     self.outfile_p.close()
+                if shm is not None:
+                    posvel = None
+                    self.positions = None
+                    self.velocities = None
+                    shm.close()
                 while not inq.empty():
                     inq.get()
                 while not cmdq.empty():
@@ -341,18 +681,24 @@ class OMMWorker(object):
         readySignal.clear()
 
 class OMMWorkerTRE(OMMWorker):
-    def _worker_setstate_fromqueue(self):
-        self.par = self._inq.get()
+    def _worker_setstate(self, par):
+        self.par = par
         self.integrator.setTemperature(self.par['temperature'])
         self.context.setParameter(self.ommsystem.parameter['temperature'], self.par['temperature']/kelvin)
-  
-    def _worker_getenergy(self):
+
+    def _worker_setstate_fromqueue(self):
+        self._worker_setstate(self._inq.get())
+
+    def _worker_energy(self):
         self.pot['potential_energy'] = self.context.getState(getEnergy = True).getPotentialEnergy()
-        self._outq.put(self.pot)
+        return self.pot
+
+    def _worker_getenergy(self):
+        self._outq.put(self._worker_energy())
 
 class OMMWorkerATM(OMMWorker):
-    def _worker_setstate_fromqueue(self):
-        self.par = self._inq.get()
+    def _worker_setstate(self, par):
+        self.par = par
         self.integrator.setTemperature(self.par['temperature'])
         self.context.setParameter(self.ommsystem.parameter['temperature'], self.par['temperature']/kelvin)
         atmforce = self.ommsystem.atmforce
@@ -363,7 +709,10 @@ class OMMWorkerATM(OMMWorker):
         self.simulation.context.setParameter(atmforce.W0(), self.par['w0'] /kilojoules_per_mole)
         self.simulation.context.setParameter(atmforce.Direction(), self.par['atmdirection'] )
 
-    def _worker_getenergy(self):
+    def _worker_setstate_fromqueue(self):
+        self._worker_setstate(self._inq.get())
+
+    def _worker_energy(self):
         if self.ommsystem.doMetaD:
             fgroups = {0,self.ommsystem.metaDforcegroup,self.ommsystem.atmforcegroup}
         else:
@@ -376,4 +725,7 @@ class OMMWorkerATM(OMMWorker):
             self.pot['bias_energy'] = state.getPotentialEnergy()
         else:
             self.pot['bias_energy'] = 0.0 * kilojoules_per_mole
-        self._outq.put(self.pot)
+        return self.pot
+
+    def _worker_getenergy(self):
+        self._outq.put(self._worker_energy())
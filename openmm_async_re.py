@@ -1,11 +1,15 @@
 from __future__ import print_function
 from __future__ import division
 import os
+import sys
 import re
+import time
 import random
 import math
 import logging
 import signal
+import multiprocessing as mp
+import numpy as np
 
 from simtk import openmm as mm
 from simtk.openmm.app import *
@@ -17,6 +21,12 @@ from local_openmm_transport import *
 from ommreplica import *
 from ommsystem import *
 from ommworker import *
+from swap_matrix import SwapMatrixTRE, SwapMatrixATM
+from checkpoint_writer import CheckpointWriter
+from trajectory_writer import TrajectoryWriter
+from uwham_analysis import load_samples, binding_free_energy
+from node_pool import NodePool, node_key
+from sample_allocation import state_sigmas, target_fractions, state_scores
 
 class openmm_job(async_re):
     def __init__(self, command_file, options):
@@ -24,7 +34,15 @@ class openmm_job(async_re):
         self.openmm_replicas = None
         self.stateparams = None
         self.openmm_workers = None
+        self.replica_store = None
+        self.workers_per_device = None
+        self.worker_template = None
+        self.node_pool = None
+        self.pending_workers = []
         self.kb = 0.0019872041*kilocalories_per_mole/kelvin
+        #shared by the compute workers to wake up the scheduler when they complete a run
+        self.completion_queue = mp.get_context('spawn').Queue()
+        self.checkpoint_writer = CheckpointWriter(logger = self.logger)
         
     def _setLogger(self):
         self.logger = logging.getLogger("async_re.openmm_async_re")
@@ -34,9 +52,154 @@ class openmm_job(async_re):
         s = signal.signal(signal.SIGINT, signal.SIG_IGN)
         # update replica objects of waiting replicas
         self.update_replica_states()
+        # the files are written by the background writer from an in-memory snapshot
+        snapshot = [replica.checkpoint_snapshot() for replica in self.openmm_replicas]
         for replica in self.openmm_replicas:
-            replica.save_checkpoint()
+            replica.flush_out()
         signal.signal(signal.SIGINT, s)
+        self.checkpoint_writer.submit(snapshot)
+
+    def setupJob(self):
+        self.trajectory_writer = self._makeTrajectoryWriter()
+        for replica in self.openmm_replicas:
+            replica.open_dcd(self.trajectory_writer)
+        # With ELASTIC_NODES = yes the slots of the NODEFILE, and of the .node files
+        # in NODE_CONTROL_DIR if set, are checked for changes every
+        # NODE_POOL_CHECK_TIME seconds (default 60)
+        elastic = self.keywords.get('ELASTIC_NODES')
+        if elastic is not None and elastic.lower() == 'yes':
+            self.node_pool = NodePool(self.keywords.get('NODEFILE'), self.keywords.get('NODE_CONTROL_DIR'))
+            if self.keywords.get('NODE_POOL_CHECK_TIME') is None:
+                self.node_pool_check_time = 60.0
+            else:
+                self.node_pool_check_time = float(self.keywords.get('NODE_POOL_CHECK_TIME'))
+            self.last_node_pool_check = time.time()
+        async_re.setupJob(self)
+
+    def _updateNodePool(self):
+        #starts workers on new slots and drains the workers of removed slots
+        if self.node_pool is None:
+            return
+        self._addPendingWorkers()
+        now = time.time()
+        if now - self.last_node_pool_check < self.node_pool_check_time:
+            return
+        self.last_node_pool_check = now
+        if not self.node_pool.changed():
+            return
+        try:
+            nodes = self.node_pool.nodes()
+        except (IOError, ValueError) as e:
+            self.logger.warning("unable to read the compute node slots: %s" % e)
+            return
+        keys = set([node_key(node) for node in nodes])
+        #the nodes being drained still hold their devices until they are retired
+        active = {}
+        for nodeid in self.transport.enabledNodes():
+            active.setdefault(node_key(self.openmm_workers[nodeid].node_info), []).append(nodeid)
+        for key, nodeids in active.items():
+            draining = [nodeid for nodeid in nodeids if self.transport.draining[nodeid]]
+            if key not in keys:
+                if len(draining) < len(nodeids):
+                    self.logger.info("slot %s:%s removed" % key)
+                for nodeid in nodeids:
+                    self.transport.drainNode(nodeid)
+            elif draining:
+                #a slot added back before its node is retired keeps its workers
+                self.logger.info("slot %s:%s added back" % key)
+                for nodeid in draining:
+                    self.transport.undrainNode(nodeid)
+        for worker in list(self.pending_workers):
+            if node_key(worker.node_info) not in keys:
+                self.pending_workers.remove(worker)
+                worker.finish()
+        pending = set([node_key(worker.node_info) for worker in self.pending_workers])
+        for node in nodes:
+            if node_key(node) not in active and node_key(node) not in pending:
+                self.logger.info("slot %s:%s added" % node_key(node))
+                for worker in self._splitWorkers([self._newWorker(node)], calibrate = False):
+                    worker.launch_worker()
+                    self.pending_workers.append(worker)
+        self.num_nodes = len(self.transport.activeNodes())
+
+    def _numNodesStarting(self):
+        return len(self.pending_workers)
+
+    def _newWorker(self, node):
+        #an unstarted worker like the first compute worker on another slot
+        template = self.worker_template
+        return type(template)(template.basename, template.ommsystem, template.keywords, node_info = node,
+                              compute = True, logger = template.logger,
+                              completion_queue = self.completion_queue, start = False)
+
+    def _addPendingWorkers(self):
+        #adds to the transport the new workers that have built their contexts
+        for worker in list(self.pending_workers):
+            if worker.is_started() or worker.has_crashed() or time.time() > worker.launch_time + worker.start_timeout:
+                self.pending_workers.remove(worker)
+                if worker.wait_worker() is None:
+                    self.logger.warning("worker %s failed to start, it will not be used" % worker.name())
+                else:
+                    self.logger.info("worker %s ready in %.1f s" % (worker.name(), worker.startup_time))
+                    self.transport.addWorker(worker)
+                    self.num_nodes = len(self.transport.activeNodes())
+
+    def _makeTrajectoryWriter(self):
+        #writes the atoms listed in TRJ_ATOMS, all atoms if not set, every TRJ_FREQUENCY steps
+        atoms = self.keywords.get('TRJ_ATOMS')
+        if atoms is not None:
+            atoms = [int(i) for i in atoms]
+        return TrajectoryWriter(self.service_worker.topology, self.service_worker.ommsystem.MDstepsize,
+                                interval = int(self.keywords.get('TRJ_FREQUENCY')), atoms = atoms,
+                                logger = self.logger)
+
+    def _startWorkers(self):
+        #the compute workers are created with start = False and build their contexts concurrently
+        self.worker_template = self.openmm_workers[0]
+        self.openmm_workers = start_workers(self._splitWorkers(self.openmm_workers), self.logger)
+        if len(self.openmm_workers) == 0:
+            self.logger.error("No compute workers could be started")
+            sys.exit(1)
+        #job slots, one per started worker
+        self.num_nodes = len(self.openmm_workers)
+
+    def _splitWorkers(self, workers, calibrate = True):
+        #runs WORKERS_PER_DEVICE workers on each CPU device, sharing its threads.
+        #With WORKERS_PER_DEVICE = auto the split with the best throughput on the first
+        #CPU device is measured with runs of CALIBRATION_STEPS steps and applied to all,
+        #including the devices added later. The calibration runs only at startup
+        #(calibrate = True) since it would stall the other devices while the job runs
+        cpu_workers = [worker for worker in workers if worker.platform_name == 'CPU']
+        if not cpu_workers:
+            return workers
+        if self.workers_per_device is None:
+            nworkers = self.keywords.get('WORKERS_PER_DEVICE')
+            if nworkers is None:
+                nworkers = 1
+            elif nworkers == 'auto' and not calibrate:
+                nworkers = 1
+                self.logger.info("no CPU device to calibrate at startup, using 1 worker per CPU device")
+            elif nworkers == 'auto':
+                nsteps = int(self.keywords.get('CALIBRATION_STEPS')) if self.keywords.get('CALIBRATION_STEPS') is not None else 1000
+                (nworkers, throughput) = calibrate_workers_per_device(cpu_workers[0], nsteps, self.logger)
+                self.logger.info("using %d workers per CPU device" % nworkers)
+            else:
+                nworkers = int(nworkers)
+            self.workers_per_device = nworkers
+        if self.workers_per_device <= 1:
+            return workers
+        split = []
+        for worker in workers:
+            if worker.platform_name == 'CPU':
+                split.extend(split_worker(worker, self.workers_per_device, self.completion_queue))
+            else:
+                split.append(worker)
+        return split
+
+    def _makeReplicaStore(self):
+        #positions and velocities of all of the replicas, memory-mapped from REPLICA_STORE_FILE if set
+        natoms = self.service_worker.topology.getNumAtoms()
+        return ReplicaStateStore(self.nreplicas, natoms, self.keywords.get('REPLICA_STORE_FILE'))
 
     def _launchReplica(self,replica,cycle):
         nsteps = int(self.keywords.get('PRODUCTION_STEPS'))
@@ -47,10 +210,14 @@ class openmm_job(async_re):
         if ntrj % nsteps != 0:
             self._exit("TRJ_FREQUENCY must be an integer multiple of PRODUCTION_STEPS.")
 
+        #a cycle shortened by the tail phase of a previous run is completed first
+        mdsteps = self.openmm_replicas[replica].get_mdsteps()
         job_info = {
             "replica": replica,
             "cycle": cycle,
-            "nsteps": nsteps,
+            "priority": self._launchPriority(replica),
+            "cycle_steps": nsteps,
+            "nsteps": nsteps - mdsteps % nsteps,
             "nprnt": nprnt,
             "ntrj": ntrj
         }
@@ -79,8 +246,8 @@ class openmm_job(async_re):
             if stateid != old_stateid:
                 temperature = par['temperature']
                 scale = math.sqrt(temperature/old_temperature)
-                for i in range(0,len(replica.velocities)):
-                    replica.velocities[i] = scale*replica.velocities[i]
+                if scale != 1.0:
+                    replica.scale_velocities(scale)
 
         #additional operations if any
         self._update_state_of_replica_addcustom(replica)
@@ -100,6 +267,10 @@ class openmm_job(async_re):
             return False
         return True
 
+    def _completedCycle(self, repl):
+        #the replica counts a cycle when all of its steps are done, see _update_replica() of the transport
+        return self.openmm_replicas[repl].get_cycle()
+
     def _getPar(self, repl):
         replica = self.openmm_replicas[repl]
         (stateid, par) = replica.get_state()
@@ -120,31 +291,12 @@ class openmm_job(async_re):
         but the energies of replicas not in waiting state, or those of waiting
         replicas for states not belonging to waiting replicas list are
         undefined.
-        """
-        # U will be sparse matrix, but is convenient bc the indices of the
-        # rows and columns will always be the same.
-        U = [[ 0. for j in range(self.nreplicas)]
-             for i in range(self.nreplicas)]
-
-        n = len(repls)
-
-        #collect replica parameters and potentials
-        par = []
-        pot = []
-        for k in repls:
-            v = self._getPot(k)
-            l = self._getPar(k)
-            par.append(l)
-            pot.append(v)
-
-        for i in range(n):
-            repl_i = repls[i]
-            for j in range(n):
-                sid_j = states[j]
-                #energy of replica i in state j
-                U[sid_j][repl_i] = self._reduced_energy(par[j],pot[i])
-        return U
 
+        The matrix is evaluated in one pass by the vectorized engine set up
+        by _buildStates() from the energies returned by _getSwapEnergies().
+        """
+        return self.swap_engine.swap_matrix(self.nreplicas, repls, states,
+                                            *self._getSwapEnergies(repls))
 
 class openmm_job_TRE(openmm_job):
     def _buildStates(self):
@@ -153,6 +305,7 @@ class openmm_job_TRE(openmm_job):
             par = {}
             par['temperature'] = float(tempt)*kelvin
             self.stateparams.append(par)
+        self.swap_engine = SwapMatrixTRE.from_stateparams(self.stateparams)
         return len(self.stateparams)
 
     def _checkInput(self):
@@ -183,11 +336,10 @@ class openmm_job_TRE(openmm_job):
         ofile.write(log)
         ofile.close()
 
-    def _reduced_energy(self, par, pot):
-        temperature = par['temperature']
-        potential_energy = pot['potential_energy']
-        beta = 1./(self.kb*temperature)
-        return beta*potential_energy
+    #potential energies (kcal/mol) of the replicas for the swap matrix engine
+    def _getSwapEnergies(self, repls):
+        epot = [self._getPot(k)['potential_energy']/kilocalories_per_mole for k in repls]
+        return (epot,)
         
 class openmm_job_ATM(openmm_job):
     def _buildStates(self):
@@ -205,8 +357,21 @@ class openmm_job_ATM(openmm_job):
                 par['w0'] = float(w0)*kilocalories_per_mole
                 par['temperature'] = float(tempt)*kelvin
                 self.stateparams.append(par)
+        self.swap_engine = SwapMatrixATM.from_stateparams(self.stateparams)
         return len(self.stateparams)
 
+    def _neighborStates(self, stateid):
+        #the adjacent alchemical states at the same temperature and the adjacent
+        #temperatures of the same alchemical state
+        nt = len(self.temperatures)
+        (l, t) = divmod(stateid, nt)
+        neighbors = [(l - 1)*nt + t, (l + 1)*nt + t]
+        if t > 0:
+            neighbors.append(stateid - 1)
+        if t < nt - 1:
+            neighbors.append(stateid + 1)
+        return [s for s in neighbors if 0 <= s < len(self.stateparams)]
+
     def _checkInput(self):
         async_re._checkInput(self)
 
@@ -244,6 +409,29 @@ class openmm_job_ATM(openmm_job):
         #build parameters for the lambda/temperatures combined states
         self.nreplicas = self._buildStates()
 
+        #UWHAM solutions of the two legs of the last free energy estimate
+        self.uwham_solution = (None, None)
+
+        # With ADAPTIVE_ALLOCATION = yes replicas in the states that contribute most
+        # to the variance of the free energy are launched first (see sample_allocation),
+        # with the share of the samples of each state between the ALLOCATION_BOUNDS
+        # (default 0.5,2.0) times the uniform share. Replicas more than
+        # ALLOCATION_MAX_LAG (default 10) cycles behind the most advanced replica
+        # are launched first regardless
+        adaptive = self.keywords.get('ADAPTIVE_ALLOCATION')
+        self.adaptive_allocation = adaptive is not None and adaptive.lower() == 'yes'
+        if self.keywords.get('ALLOCATION_BOUNDS') is None:
+            self.allocation_bounds = (0.5, 2.0)
+        else:
+            self.allocation_bounds = tuple(float(b) for b in self.keywords.get('ALLOCATION_BOUNDS').split(','))
+            if len(self.allocation_bounds) != 2 or not self.allocation_bounds[0] <= 1.0 <= self.allocation_bounds[1]:
+                self._exit("ALLOCATION_BOUNDS must be two numbers, the first not above 1 and the second not below 1")
+        if self.keywords.get('ALLOCATION_MAX_LAG') is None:
+            self.allocation_max_lag = 10
+        else:
+            self.allocation_max_lag = int(self.keywords.get('ALLOCATION_MAX_LAG'))
+        self.state_score = None
+
     def print_status(self):
         """
         Writes to BASENAME_stat.txt a text version of the status of the RE job
@@ -260,60 +448,71 @@ class openmm_job_ATM(openmm_job):
             log += "%6d   %5d  %6.3f %6.3f %6.3f %6.3f %6.2f %6.2f %6.2f %5s  %5d\n" % (k, stateid, self.stateparams[stateid]['lambda'], self.stateparams[stateid]['lambda1'], self.stateparams[stateid]['lambda2'], self.stateparams[stateid]['alpha']*kilocalories_per_mole, self.stateparams[stateid]['u0']/kilocalories_per_mole, self.stateparams[stateid]['w0']/kilocalories_per_mole, self.stateparams[stateid]['temperature']/kelvin, self.status[k]['running_status'], self.status[k]['cycle_current'])
         log += "Running = %d\n" % self.running
         log += "Waiting = %d\n" % self.waiting
+        if self.dgb_estimate is not None:
+            log += "DGb = %f +- %f\n" % self.dgb_estimate
 
         ofile.write(log)
         ofile.close()
 
-    #evaluates the softplus function
-    def _softplus(self, lambda1, lambda2, alpha, u0, w0, uf):
-        ee = 1.0 + math.exp(-alpha*(uf-u0))
-        softplusf = lambda2 * uf + w0
-        if alpha._value > 0.:
-            softplusf += ((lambda2 - lambda1)/alpha) * math.log(ee)
-        return softplusf
+    #potential and perturbation energies (kcal/mol) of the replicas for the swap matrix engine,
+    #the unperturbed energies are obtained by the engine from the replicas' current states
+    def _getSwapEnergies(self, repls):
+        pots = [self.openmm_replicas[k].get_energy() for k in repls]
+        epot = [pot['potential_energy']/kilocalories_per_mole for pot in pots]
+        pertpot = [pot['perturbation_energy']/kilocalories_per_mole for pot in pots]
+        return (epot, pertpot)
 
-    #customized getPot to return the unperturbed potential energy
-    #of the replica U0 = U - W_lambda(u)
-    def _getPot(self, repl):
-        replica = self.openmm_replicas[repl]
-        pot = replica.get_energy()
-        epot = pot['potential_energy']
-        pertpot = pot['perturbation_energy']
-        (stateid, par) = replica.get_state()
-        direction = par['atmdirection']
-        lambda1 = par['lambda1']
-        lambda2 = par['lambda2']
-        alpha = par['alpha']
-        u0 = par['u0']
-        w0 = par['w0']
-        ebias = self._softplus(lambda1, lambda2, alpha, u0, w0, pertpot)
-        pot['unbiased_potential_energy'] = epot - ebias
-        pot['direction'] = par['atmdirection']
-        pot['intermediate'] = par['atmintermediate']
-        return pot
-
-    def _reduced_energy(self, par, pot):
-        temperature = par['temperature']
-        beta = 1./(self.kb*temperature)
-        direction = par['atmdirection']
-        lambda1 = par['lambda1']
-        lambda2 = par['lambda2']
-        alpha = par['alpha']
-        u0 = par['u0']
-        w0 = par['w0']
-        state_direction = par['atmdirection']
-        state_intermediate = par['atmintermediate']
-        epot0 = pot['unbiased_potential_energy']
-        pertpot = pot['perturbation_energy']
-        replica_direction = pot['direction']
-        replica_intermediate = pot['intermediate']
-        if (replica_direction == state_direction) or (state_intermediate > 0 and replica_intermediate > 0):
-            ebias = self._softplus(lambda1, lambda2, alpha, u0, w0, pertpot)
-            return beta*(epot0 + ebias)
-        else:
-            #prevent exchange
-            large_energy = 1.e12
-            return large_energy
+    def _loadSamples(self):
+        #samples collected so far, without the first DGB_DISCARD_SAMPLES samples of each replica
+        for replica in self.openmm_replicas:
+            replica.flush_out()
+        discard = 0
+        if self.keywords.get('DGB_DISCARD_SAMPLES') is not None:
+            discard = int(self.keywords.get('DGB_DISCARD_SAMPLES'))
+        return load_samples(self.basename, self.nreplicas, discard + 1)
+
+    def _estimateFreeEnergy(self):
+        #binding free energy (DDGb for RBFE) at the first temperature from the samples collected so far,
+        #warm-started from the previous estimate. The first DGB_DISCARD_SAMPLES samples of each replica are discarded.
+        try:
+            (samples, nsamples) = self._loadSamples()
+            (dgb, ddgb, self.uwham_solution) = binding_free_energy(self.keywords, samples, self.uwham_solution)
+        except (ValueError, IndexError, np.linalg.LinAlgError) as e:
+            self.logger.warning("unable to estimate the free energy: %s" % e)
+            return None
+        if not (np.isfinite(dgb[0]) and np.isfinite(ddgb[0])):
+            return None
+        return (float(dgb[0]), float(ddgb[0]))
+
+    def _updateAllocation(self):
+        #ranks the states by the deficit of their samples relative to the Neyman allocation
+        if not self.adaptive_allocation:
+            return
+        try:
+            (samples, nsamples) = self._loadSamples()
+        except (IOError, ValueError, IndexError) as e:
+            self.logger.warning("unable to update the sampling allocation: %s" % e)
+            return
+        nstates = len(self.stateparams)
+        if len(samples['stateid']) == 0:
+            return
+        counts = np.bincount(samples['stateid'], minlength=nstates)
+        sigma = state_sigmas(self.swap_engine, samples, [self._neighborStates(s) for s in range(nstates)])
+        fractions = target_fractions(sigma, *self.allocation_bounds)
+        self.state_score = state_scores(fractions, counts)
+        #replicas already queued are moved according to the new scores
+        self._reprioritizeJobs()
+        self.logger.info("sampling allocation: target share " +
+                         " ".join(["%d:%.3f/%.3f" % (s, fractions[s], counts[s]/counts.sum()) for s in range(nstates)]))
+
+    def _allocationScore(self, repl):
+        if self.state_score is None:
+            return 0.0
+        #fairness bound: replicas far behind are launched first
+        cycles = self.status.cycle
+        if cycles.max() - cycles[repl] > self.allocation_max_lag:
+            return len(self.state_score)/(len(self.state_score) + 1.)
+        return float(self.state_score[self.status[repl]['stateid_current']])
 
     def _update_state_of_replica_addcustom(self, replica):
         #changes the format of the positions in case of an exchange between replicas with two different directions 
@@ -332,26 +531,25 @@ class openmm_job_AmberTRE(openmm_job_TRE):
 
         #builds service worker for replicas use
         service_ommsys = OMMSystemAmberTRE(self.basename, self.keywords, prmtopfile, crdfile, self.logger)
-        self.service_worker = OMMWorkerTRE(self.basename, ommsys, self.keywords, compute = False, logger = self.logger)
+        self.service_worker = OMMWorkerTRE(self.basename, service_ommsys, self.keywords, compute = False, logger = self.logger)
+        #the compute workers deserialize the System built by the service worker
+        system_data = service_ommsys.system_data_of()
         #creates openmm replica objects
+        self.replica_store = self._makeReplicaStore()
         self.openmm_replicas = []
         for i in range(self.nreplicas):
-            replica = OMMReplicaTRE(i, self.basename, self.service_worker, self.logger)
+            replica = OMMReplicaTRE(i, self.basename, self.service_worker, self.logger, store = self.replica_store)
             if replica.stateid == None:
                 replica.set_state(i, self.stateparams[i])#initial setting
             self.openmm_replicas.append(replica)
 
         # creates openmm workers
         self.openmm_workers = []
-        pattern = re.compile('(\d+):(\d+)')
         for node in self.compute_nodes:
-            slot_id = node["slot_number"]
-            matches = pattern.search(slot_id)
-            platform_id = int(matches.group(1))
-            device_id = int(matches.group(2))
-            gpu_platform_name = node["arch"]
             ommsys = OMMSystemAmberTRE(self.basename, self.keywords, prmtopfile, crdfile, self.logger)
-            self.openmm_workers.append(OMMWorkerTRE(self.basename, ommsys, self.keywords, gpu_platform_name, platform_id, device_id, compute = True, logger = self.logger))
+            ommsys.system_data = system_data
+            self.openmm_workers.append(OMMWorkerTRE(self.basename, ommsys, self.keywords, node_info = node, compute = True, logger = self.logger, completion_queue = self.completion_queue, start = False))
+        self._startWorkers()
 
 class openmm_job_AmberABFE(openmm_job_ATM):
     def __init__(self, command_file, options):
@@ -366,10 +564,13 @@ class openmm_job_AmberABFE(openmm_job_ATM):
         #builds service worker for replicas use
         service_ommsys = OMMSystemAmberABFE(self.basename, self.keywords, prmtopfile, crdfile, self.logger)
         self.service_worker = OMMWorkerATM(self.basename, service_ommsys, self.keywords, compute = False, logger = self.logger)
+        #the compute workers deserialize the System built by the service worker
+        system_data = service_ommsys.system_data_of()
         #creates openmm replica objects
+        self.replica_store = self._makeReplicaStore()
         self.openmm_replicas = []
         for i in range(self.nreplicas):
-            replica = OMMReplicaATM(i, self.basename, self.service_worker, self.logger)
+            replica = OMMReplicaATM(i, self.basename, self.service_worker, self.logger, store = self.replica_store)
             if replica.stateid == None:
                 replica.set_state(i, self.stateparams[i])#initial setting
             self.openmm_replicas.append(replica)
@@ -378,7 +579,9 @@ class openmm_job_AmberABFE(openmm_job_ATM):
         self.openmm_workers = []
         for node in self.compute_nodes:
             ommsys = OMMSystemAmberABFE(self.basename, self.keywords, prmtopfile, crdfile, self.logger) 
-            self.openmm_workers.append(OMMWorkerATM(self.basename, ommsys, self.keywords, node_info = node, compute = True, logger = self.logger))
+            ommsys.system_data = system_data
+            self.openmm_workers.append(OMMWorkerATM(self.basename, ommsys, self.keywords, node_info = node, compute = True, logger = self.logger, completion_queue = self.completion_queue, start = False))
+        self._startWorkers()
 
 class openmm_job_AmberRBFE(openmm_job_ATM):
     def __init__(self, command_file, options):
@@ -393,10 +596,13 @@ class openmm_job_AmberRBFE(openmm_job_ATM):
         #builds service worker for replicas use
         service_ommsys = OMMSystemAmberRBFE(self.basename, self.keywords, prmtopfile, crdfile, self.logger)
         self.service_worker = OMMWorkerATM(self.basename, service_ommsys, self.keywords, compute = False, logger = self.logger)
+        #the compute workers deserialize the System built by the service worker
+        system_data = service_ommsys.system_data_of()
         #creates openmm replica objects
+        self.replica_store = self._makeReplicaStore()
         self.openmm_replicas = []
         for i in range(self.nreplicas):
-            replica = OMMReplicaATM(i, self.basename, self.service_worker, self.logger)
+            replica = OMMReplicaATM(i, self.basename, self.service_worker, self.logger, store = self.replica_store)
             if replica.stateid == None:
                 replica.set_state(i, self.stateparams[i])#initial setting
             self.openmm_replicas.append(replica)
@@ -405,5 +611,7 @@ class openmm_job_AmberRBFE(openmm_job_ATM):
         self.openmm_workers = []
         for node in self.compute_nodes:
             ommsys = OMMSystemAmberRBFE(self.basename, self.keywords, prmtopfile, crdfile, self.logger) 
-            self.openmm_workers.append(OMMWorkerATM(self.basename, ommsys, self.keywords, node_info = node, compute = True, logger = self.logger))
+            ommsys.system_data = system_data
+            self.openmm_workers.append(OMMWorkerATM(self.basename, ommsys, self.keywords, node_info = node, compute = True, logger = self.logger, completion_queue = self.completion_queue, start = False))
+        self._startWorkers()
 
@@ -0,0 +1,112 @@
+"""
+Status table of the replicas of an asynchronous RE job
+"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+
+class ReplicaStatusTable(object):
+    """
+    Holds the current state id, running status ('W' waiting, 'R' running,
+    'S' stopped) and cycle of each replica in NumPy arrays, together with the
+    sets of the replicas in wait and running states and of the replicas that
+    have completed only part of their current cycle. The sets are updated on
+    every change of running status so that the lists of waiting and running
+    replicas are available without scanning the table.
+
+    status[k] returns a dictionary-like view of replica k with the
+    'stateid_current', 'running_status' and 'cycle_current' keys. Assignments
+    through the view update the table and its indexes.
+    """
+    def __init__(self, nreplicas):
+        self.nreplicas = nreplicas
+        self.stateid = np.arange(nreplicas, dtype=np.int64)
+        self.running_status = np.full(nreplicas, 'W', dtype='U1')
+        self.cycle = np.ones(nreplicas, dtype=np.int64)
+        self.waiting = set(range(nreplicas))
+        self.running = set()
+        self.midcycle = set()
+        self._rows = [ReplicaStatus(self, k) for k in range(nreplicas)]
+
+    def __len__(self):
+        return self.nreplicas
+
+    def __getitem__(self, k):
+        return self._rows[k]
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def _index(self, running_status):
+        if running_status == 'W':
+            return self.waiting
+        elif running_status == 'R':
+            return self.running
+        return None
+
+    def set_running_status(self, k, running_status):
+        old = self.running_status[k]
+        if old == running_status:
+            return
+        index = self._index(old)
+        if index is not None:
+            index.discard(k)
+        index = self._index(running_status)
+        if index is not None:
+            index.add(k)
+        self.running_status[k] = running_status
+
+    def set_stateid(self, k, stateid):
+        self.stateid[k] = stateid
+
+    def set_cycle(self, k, cycle):
+        self.cycle[k] = cycle
+
+    def set_midcycle(self, k, midcycle):
+        if midcycle:
+            self.midcycle.add(k)
+        else:
+            self.midcycle.discard(k)
+
+    def replicas_waiting(self):
+        return sorted(self.waiting)
+
+    def replicas_running(self):
+        return sorted(self.running)
+
+    def replicas_waiting_to_exchange(self):
+        # replicas in a wait state that have ALSO completed at least one cycle
+        # and are not in the middle of a cycle
+        return [k for k in sorted(self.waiting - self.midcycle) if self.cycle[k] > 1]
+
+    def states_of(self, replicas):
+        return self.stateid[replicas].tolist()
+
+class ReplicaStatus(object):
+    """
+    Dictionary-like view of the status of one replica in a ReplicaStatusTable
+    """
+    _setters = {'stateid_current': 'set_stateid',
+                'running_status': 'set_running_status',
+                'cycle_current': 'set_cycle'}
+
+    def __init__(self, table, k):
+        self._table = table
+        self._k = k
+
+    def __getitem__(self, key):
+        if key == 'stateid_current':
+            return int(self._table.stateid[self._k])
+        elif key == 'running_status':
+            return str(self._table.running_status[self._k])
+        elif key == 'cycle_current':
+            return int(self._table.cycle[self._k])
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._setters:
+            raise KeyError(key)
+        getattr(self._table, self._setters[key])(self._k, value)
+
+    def __repr__(self):
+        return repr({key: self[key] for key in self._setters})
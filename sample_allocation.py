@@ -0,0 +1,87 @@
+"""
+Allocation of MD sampling among the thermodynamic states of an ATM job
+
+The variance of the free energy estimate is dominated by the states with
+the poorest overlap with their neighbors. The per-sample variance of the
+free energy perturbation estimate of the free energy difference between a
+state and each of its neighbors is computed from the samples collected so
+far. The variance of the estimate is minimized by sampling each state in
+proportion to the square root of its variance (Neyman allocation). The
+resulting shares are kept within bounds relative to the uniform share so
+that no state is starved or oversampled.
+"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+
+def fep_variance(du):
+    """
+    Returns the variance of the free energy perturbation estimate,
+    -log <exp(-du)>, from one sample of the reduced energy differences du,
+    i.e. var(exp(-du))/<exp(-du)>^2
+    """
+    x = -np.asarray(du, dtype=np.float64)
+    w = np.exp(x - x.max())
+    mean = w.mean()
+    return w.var()/(mean*mean)
+
+def state_sigmas(swap_engine, samples, neighbors):
+    """
+    Returns for each state the square root of the sum of the per-sample
+    variances of the free energy perturbation estimates to each of its
+    neighbors (neighbors[s] lists the neighbors of state s). States with
+    fewer than two samples are given the largest value of the others.
+    """
+    nstates = swap_engine.nstates
+    stateid = samples['stateid']
+    sigma = np.full(nstates, np.nan)
+    for s in range(nstates):
+        select = stateid == s
+        if np.count_nonzero(select) < 2:
+            continue
+        e0 = swap_engine.unbiased_energies(stateid[select], samples['potE'][select], samples['pertE'][select])
+        states = np.array([s] + list(neighbors[s]), dtype=np.intp)
+        u = swap_engine.beta[states][:,None]*(e0[None,:] + swap_engine.bias_energies(states, samples['pertE'][select]))
+        sigma[s] = np.sqrt(sum(fep_variance(u[j] - u[0]) for j in range(1, len(states))))
+    sampled = np.isfinite(sigma)
+    if not np.any(sampled):
+        return np.ones(nstates)
+    sigma[~sampled] = sigma[sampled].max()
+    return sigma
+
+def target_fractions(sigma, lower = 0.5, upper = 2.0):
+    """
+    Returns the fractions of the samples to collect in each state, in
+    proportion to sigma and bounded to between lower and upper times the
+    uniform fraction (lower <= 1 <= upper).
+    """
+    sigma = np.asarray(sigma, dtype=np.float64)
+    n = len(sigma)
+    lo = lower/n
+    hi = upper/n
+    if sigma.sum() <= 0:
+        return np.full(n, 1./n)
+    #the fractions clip(c sigma, lo, hi) sum to one for a single scale c,
+    #found by bisection since their sum is nondecreasing in c
+    sigma = np.maximum(sigma, 1.e-12*sigma.max())
+    (cmin, cmax) = (0., hi/sigma.min())
+    for it in range(100):
+        c = 0.5*(cmin + cmax)
+        if np.clip(c*sigma, lo, hi).sum() < 1.:
+            cmin = c
+        else:
+            cmax = c
+    fractions = np.clip(cmax*sigma, lo, hi)
+    return fractions/fractions.sum()
+
+def state_scores(fractions, counts):
+    """
+    Returns a score in [0,1) of each state ranking the deficit of its samples
+    relative to the target fractions, the state with the largest deficit
+    having the highest score.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    n = len(counts)
+    deficit = fractions*counts.sum() - counts
+    rank = np.argsort(np.argsort(deficit, kind='stable'), kind='stable')
+    return rank/(n + 1.)
@@ -0,0 +1,192 @@
+"""
+Columnar binary log of the samples of a replica
+
+The samples of replica k are stored under r<k>/<basename>_samples/, one raw
+little-endian file per column (<column>.bin). Rows are buffered in memory and
+appended to the column files according to a flush policy. The columns are
+read back as memory-mapped arrays, truncated to the length of the shortest
+column so that a write interrupted between two columns drops the incomplete
+row.
+
+Energies are in kcal/mol, alpha in (kcal/mol)^-1 and temperatures in kelvin,
+as in the legacy r<k>/<basename>.out text files. Columns that do not apply to
+a job (e.g. the alchemical parameters of temperature RE) are NaN.
+
+Usage:
+
+  python sample_log.py export <basename>  writes r*/<basename>.out from the binary logs
+  python sample_log.py import <basename>  creates the binary logs from r*/<basename>.out
+
+The legacy files of temperature RE jobs have the stateid, temperature and
+potE columns only. Import refuses to overwrite a log that already holds
+samples.
+"""
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import time
+import numpy as np
+
+SAMPLE_COLUMNS = (('replica', '<i4'),
+                  ('cycle', '<i8'),
+                  ('stateid', '<i4'),
+                  ('temperature', '<f8'),
+                  ('direction', '<f8'),
+                  ('lambda1', '<f8'),
+                  ('lambda2', '<f8'),
+                  ('alpha', '<f8'),
+                  ('u0', '<f8'),
+                  ('w0', '<f8'),
+                  ('potE', '<f8'),
+                  ('pertE', '<f8'),
+                  ('biasE', '<f8'))
+
+#columns of the legacy text files, in order
+LEGACY_COLUMNS = ('stateid', 'temperature', 'direction', 'lambda1', 'lambda2', 'alpha',
+                  'u0', 'w0', 'potE', 'pertE', 'biasE')
+#columns of the legacy text files of temperature RE jobs
+LEGACY_COLUMNS_TRE = ('stateid', 'temperature', 'potE')
+
+def legacy_columns(ncolumns):
+    #columns of a legacy text file with ncolumns columns
+    if ncolumns == len(LEGACY_COLUMNS_TRE):
+        return LEGACY_COLUMNS_TRE
+    return LEGACY_COLUMNS
+
+def sample_log_dir(replica, basename):
+    return 'r%d/%s_samples' % (replica, basename)
+
+def _column_file(dirname, name):
+    return os.path.join(dirname, name + '.bin')
+
+def has_samples(dirname):
+    #true if the sample log exists and holds at least one sample
+    return os.path.isdir(dirname) and min(_column_lengths(dirname)) > 0
+
+def _column_lengths(dirname):
+    lengths = []
+    for name, dtype in SAMPLE_COLUMNS:
+        filename = _column_file(dirname, name)
+        size = os.path.getsize(filename) if os.path.isfile(filename) else 0
+        lengths.append(size // np.dtype(dtype).itemsize)
+    return lengths
+
+class SampleLogWriter(object):
+    """
+    Append-only writer of a sample log. Buffered rows are written out when
+    flush_samples rows have accumulated or flush_interval seconds have passed
+    since the last write, whichever comes first, and by flush() and close().
+    """
+    def __init__(self, dirname, flush_samples = 100, flush_interval = 60.0):
+        self.dirname = dirname
+        self.flush_samples = flush_samples
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.last_flush = time.time()
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        #drops the trailing partial row of an interrupted write
+        nrows = min(_column_lengths(dirname))
+        for name, dtype in SAMPLE_COLUMNS:
+            filename = _column_file(dirname, name)
+            with open(filename, 'ab') as f:
+                f.truncate(nrows*np.dtype(dtype).itemsize)
+
+    def set_flush_policy(self, flush_samples, flush_interval):
+        self.flush_samples = flush_samples
+        self.flush_interval = flush_interval
+
+    def append(self, **sample):
+        #missing columns are stored as NaN (floats) or -1 (integers)
+        self.rows.append(sample)
+        if len(self.rows) >= self.flush_samples or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            for name, dtype in SAMPLE_COLUMNS:
+                missing = -1 if np.dtype(dtype).kind == 'i' else np.nan
+                column = np.array([row.get(name, missing) for row in self.rows], dtype=dtype)
+                with open(_column_file(self.dirname, name), 'ab') as f:
+                    f.write(column.tobytes())
+            self.rows = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+
+def read_sample_log(dirname, mmap = True):
+    """
+    Returns a dictionary of the columns of a sample log as arrays, memory-mapped
+    read-only if mmap is True.
+    """
+    nrows = min(_column_lengths(dirname))
+    columns = {}
+    for name, dtype in SAMPLE_COLUMNS:
+        filename = _column_file(dirname, name)
+        if nrows == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        elif mmap:
+            columns[name] = np.memmap(filename, dtype=dtype, mode='r', shape=(nrows,))
+        else:
+            columns[name] = np.fromfile(filename, dtype=dtype, count=nrows)
+    return columns
+
+def read_sample_logs(dirnames):
+    """
+    Returns the columns of several sample logs concatenated in memory
+    """
+    logs = [read_sample_log(dirname, mmap = True) for dirname in dirnames]
+    return {name: np.concatenate([log[name] for log in logs]) for name, dtype in SAMPLE_COLUMNS}
+
+def write_legacy_out(dirname, outfilename):
+    """
+    Writes a sample log in the format of the legacy .out text files, with
+    the columns of temperature RE if the alchemical columns are not set
+    """
+    columns = read_sample_log(dirname)
+    names = LEGACY_COLUMNS
+    if len(columns['direction']) > 0 and np.all(np.isnan(columns['direction'])):
+        names = LEGACY_COLUMNS_TRE
+    line = "%d" + " %f"*(len(names) - 1) + "\n"
+    with open(outfilename, 'w') as f:
+        for i in range(len(columns['stateid'])):
+            f.write(line % tuple(columns[name][i] for name in names))
+
+def read_legacy_out(outfilename, dirname, replica):
+    """
+    Creates a sample log from a legacy .out text file of an ATM or temperature
+    RE job. The cycle of each sample is taken as its line number. Raises
+    IOError if the sample log already holds samples.
+    """
+    if has_samples(dirname):
+        raise IOError("sample log %s already exists" % dirname)
+    writer = SampleLogWriter(dirname, flush_samples = sys.maxsize, flush_interval = float('inf'))
+    with open(outfilename, 'r') as f:
+        for cycle, line in enumerate(f, 1):
+            values = line.split()
+            if not values:
+                continue
+            sample = {name: float(value) for name, value in zip(legacy_columns(len(values)), values)}
+            sample['stateid'] = int(sample['stateid'])
+            writer.append(replica = replica, cycle = cycle, **sample)
+    writer.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ('export', 'import'):
+        print("usage: python sample_log.py export|import <basename>")
+        sys.exit(1)
+    command, basename = sys.argv[1], sys.argv[2]
+    replica = 0
+    while os.path.isdir('r%d' % replica):
+        outfilename = 'r%d/%s.out' % (replica, basename)
+        dirname = sample_log_dir(replica, basename)
+        if command == 'export' and os.path.isdir(dirname):
+            write_legacy_out(dirname, outfilename)
+        elif command == 'import' and os.path.isfile(outfilename):
+            try:
+                read_legacy_out(outfilename, dirname, replica)
+            except IOError as e:
+                print("%s: not imported, %s" % (outfilename, e))
+        replica += 1
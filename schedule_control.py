@@ -0,0 +1,99 @@
+"""
+Runtime tuning of the scheduling parameters of an asynchronous RE job
+"""
+from __future__ import print_function
+from __future__ import division
+import logging
+
+class ScheduleController(object):
+    """
+    Feedback controller of the scheduling parameters of scheduleJobs():
+
+      cycle_time   longest time (s) the scheduler waits on the devices before
+                   exchanging and relaunching replicas
+      min_time     polling interval (s) of the job queue and of the workers
+      buffer_size  number of replicas queued beyond the number of devices,
+                   as a fraction of the number of devices
+      margin       time (s) before the end of the wall time at which no more
+                   replicas are launched
+
+    update() is called once per scheduling cycle with the measured replica
+    cycle durations of the devices, the duration of the last exchange and
+    the accumulated idle time of the devices. The queue depth is increased
+    when the devices are idle more than target_idle of the time and decreased
+    when they are idle less than half of that, so that as many replicas as
+    possible are left waiting for exchanges. The other parameters are set
+    from the cycle durations. Every change is logged.
+    """
+    def __init__(self, cycle_time, min_time, buffer_size, margin, target_idle = 0.05, logger = None):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger("async_re.schedule_control")
+        self.cycle_time = cycle_time
+        self.min_time = min_time
+        self.buffer_size = buffer_size
+        self.margin = margin
+        self.target_idle = target_idle
+        self.max_buffer_size = 2.0
+        self.buffer_step = 0.1
+        #moving averages of the measurements and the weight of the latest one
+        self.smoothing = 0.3
+        self.idle_fraction = None
+        self.exchange_time = None
+        self.checkpoint_time = 0.0
+        self._last_idle = None
+        self._last_time = None
+        self._last_buffer_change = None
+
+    def _set(self, name, value, reason, tolerance = 0.1):
+        #changes a parameter if it differs from its current value by more than tolerance (relative)
+        old = getattr(self, name)
+        if abs(value - old) <= tolerance*max(abs(old), 1.e-6):
+            return
+        setattr(self, name, value)
+        self.logger.info("schedule control: %s %.3f -> %.3f (%s)" % (name, old, value, reason))
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return old + self.smoothing*(new - old)
+
+    def add_checkpoint_time(self, seconds):
+        self.checkpoint_time = max(self.checkpoint_time, seconds)
+
+    def update(self, cycle_durations, exchange_time, idle_time, nprocs, now):
+        self.exchange_time = self._average(self.exchange_time, exchange_time)
+        if self._last_time is not None and now > self._last_time and nprocs > 0:
+            fraction = (idle_time - self._last_idle)/((now - self._last_time)*nprocs)
+            self.idle_fraction = self._average(self.idle_fraction, min(max(fraction, 0.0), 1.0))
+        self._last_idle = idle_time
+        self._last_time = now
+
+        if len(cycle_durations) == 0 or nprocs == 0:
+            return
+        duration = sum(cycle_durations)/len(cycle_durations)
+        longest = max(cycle_durations)
+
+        #polls often enough to relaunch a replica within a small fraction of a cycle
+        self._set('min_time', min(max(duration/50., 0.05), 5.0),
+                  "average cycle %.1f s" % duration)
+        #returns to exchange about every time two devices complete a cycle
+        self._set('cycle_time', min(max(2.*duration/nprocs, self.min_time), duration),
+                  "average cycle %.1f s on %d devices" % (duration, nprocs))
+        #leaves time for the slowest device to complete the last two launches
+        self._set('margin', 2.*longest + self.exchange_time + self.checkpoint_time,
+                  "longest cycle %.1f s, exchange %.3f s, checkpoint %.1f s" %
+                  (longest, self.exchange_time, self.checkpoint_time))
+
+        #the queue depth is changed at most once per cycle so that the idle fraction can respond
+        if self.idle_fraction is None:
+            return
+        if self._last_buffer_change is not None and now - self._last_buffer_change < duration:
+            return
+        self._last_buffer_change = now
+        if self.idle_fraction > self.target_idle:
+            self._set('buffer_size', min(self.buffer_size + self.buffer_step, self.max_buffer_size),
+                      "device idle fraction %.3f" % self.idle_fraction, tolerance = 0.0)
+        elif self.idle_fraction < 0.5*self.target_idle:
+            self._set('buffer_size', max(self.buffer_size - self.buffer_step, 0.0),
+                      "device idle fraction %.3f" % self.idle_fraction, tolerance = 0.0)
@@ -24,7 +24,7 @@ from async_re import __version__ as VERSION
 
 NAME = 'async_re'
 
-MODULES = 'async_re', 'ommreplica', 'ommsystem', 'ommworker', 'local_openmm_transport', 'transport', 'gibbs_sampling', 'openmm_async_re'
+MODULES = 'async_re', 'ommreplica', 'ommsystem', 'ommworker', 'local_openmm_transport', 'transport', 'gibbs_sampling', 'swap_matrix', 'replica_status', 'checkpoint_writer', 'sample_log', 'trajectory_writer', 'uwham_analysis', 'schedule_control', 'node_pool', 'job_queue', 'sample_allocation', 'openmm_async_re'
 
 
 SCRIPTS = 'abfe_explicit.py', 'rbfe_explicit.py', 'abfe_structprep.py', 'rbfe_structprep.py', 'rbfe_explicit_sync.py'
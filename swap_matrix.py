@@ -0,0 +1,150 @@
+"""
+Vectorized evaluation of the replica exchange swap matrix
+
+The swap matrix U[a][i] holds the reduced energy of replica i in state a.
+The engines below hold the parameters of the thermodynamic states as unitless
+NumPy arrays (energies in kcal/mol, temperatures in kelvin) so that the reduced
+energies of all of the waiting replicas in all of their states are evaluated
+in one pass rather than by a double loop over simtk.unit Quantities.
+"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+
+try:
+    from openmm.unit import kelvin, kilocalories_per_mole
+except ImportError:
+    from simtk.unit import kelvin, kilocalories_per_mole
+
+#Boltzmann's constant in kcal/(mol K)
+KB = 0.0019872041
+
+#reduced energy assigned to replica/state pairs that are not allowed to exchange
+LARGE_ENERGY = 1.e12
+
+def softplus(lambda1, lambda2, alpha, u0, w0, uf):
+    """
+    Evaluates the softplus alchemical potential
+
+    (lambda2-lambda1) ln[1+exp(-alpha (uf-u0))]/alpha + lambda2 uf + w0
+
+    Energies are in kcal/mol and alpha in (kcal/mol)^-1. The arguments are
+    broadcast against each other, so passing the state parameters as column
+    vectors and uf as a row vector returns a states x replicas matrix.
+    """
+    lambda1, lambda2, alpha, u0, w0, uf = np.broadcast_arrays(
+        *[np.asarray(a, dtype=np.float64) for a in (lambda1, lambda2, alpha, u0, w0, uf)])
+    softplusf = lambda2 * uf + w0
+    active = alpha > 0.
+    if np.any(active):
+        #log(1+exp(x)) evaluated without overflow
+        a = alpha[active]
+        softplusf[active] += ((lambda2[active] - lambda1[active])/a) * np.logaddexp(0., -a*(uf[active]-u0[active]))
+    return softplusf
+
+class SwapMatrixTRE(object):
+    """
+    Swap matrix engine for temperature replica exchange: u_a(i) = beta_a U(i)
+    """
+    def __init__(self, temperatures):
+        self.temperatures = np.asarray(temperatures, dtype=np.float64)
+        self.beta = 1./(KB*self.temperatures)
+        self.nstates = len(self.temperatures)
+
+    @classmethod
+    def from_stateparams(cls, stateparams):
+        return cls([par['temperature']/kelvin for par in stateparams])
+
+    def reduced_energies(self, states, epot):
+        """
+        Returns the len(states) x len(epot) matrix of the reduced energies of
+        the replicas with potential energies epot (kcal/mol) in the given states.
+        """
+        states = np.asarray(states, dtype=np.intp)
+        epot = np.asarray(epot, dtype=np.float64)
+        return self.beta[states][:,None]*epot[None,:]
+
+    def swap_matrix(self, nreplicas, repls, states, *energies):
+        """
+        Returns the nreplicas x nreplicas swap matrix U where U[states[j]][repls[i]]
+        is the reduced energy of replica repls[i] in state states[j]. states[i]
+        is the state currently occupied by replica repls[i]. The elements
+        of U outside of the waiting replicas/states are left at zero.
+        """
+        U = np.zeros((nreplicas, nreplicas))
+        if len(repls) > 0:
+            U[np.ix_(np.asarray(states, dtype=np.intp), np.asarray(repls, dtype=np.intp))] = self.reduced_energies(states, *energies)
+        return U
+
+class SwapMatrixATM(SwapMatrixTRE):
+    """
+    Swap matrix engine for ATM alchemical replica exchange:
+
+    u_a(i) = beta_a [ U0(i) + W_a(u(i)) ]
+
+    where U0 = U - W_b(u) is the unperturbed energy of replica i, currently in
+    state b, W is the softplus alchemical potential and u the perturbation
+    energy. Replicas are allowed to visit only states with the same direction
+    of the transformation, unless both states are intermediate states.
+    """
+    def __init__(self, temperatures, lambda1, lambda2, alpha, u0, w0, direction, intermediate):
+        super().__init__(temperatures)
+        self.lambda1 = np.asarray(lambda1, dtype=np.float64)
+        self.lambda2 = np.asarray(lambda2, dtype=np.float64)
+        self.alpha = np.asarray(alpha, dtype=np.float64)
+        self.u0 = np.asarray(u0, dtype=np.float64)
+        self.w0 = np.asarray(w0, dtype=np.float64)
+        self.direction = np.asarray(direction, dtype=np.float64)
+        self.intermediate = np.asarray(intermediate, dtype=np.float64)
+
+    @classmethod
+    def from_stateparams(cls, stateparams):
+        return cls([par['temperature']/kelvin for par in stateparams],
+                   [par['lambda1'] for par in stateparams],
+                   [par['lambda2'] for par in stateparams],
+                   [par['alpha']*kilocalories_per_mole for par in stateparams],
+                   [par['u0']/kilocalories_per_mole for par in stateparams],
+                   [par['w0']/kilocalories_per_mole for par in stateparams],
+                   [par['atmdirection'] for par in stateparams],
+                   [par['atmintermediate'] for par in stateparams])
+
+    def bias_energies(self, states, pertpot):
+        """
+        Returns the len(states) x len(pertpot) matrix of the alchemical
+        potentials of the given perturbation energies in the given states.
+        """
+        s = np.asarray(states, dtype=np.intp)[:,None]
+        return softplus(self.lambda1[s], self.lambda2[s], self.alpha[s], self.u0[s], self.w0[s],
+                        np.asarray(pertpot, dtype=np.float64)[None,:])
+
+    def unbiased_energies(self, states, epot, pertpot):
+        """
+        Returns the unperturbed potential energies, U0 = U - W(u), of replicas
+        with potential energies epot and perturbation energies pertpot
+        currently in the given states.
+        """
+        s = np.asarray(states, dtype=np.intp)
+        ebias = softplus(self.lambda1[s], self.lambda2[s], self.alpha[s], self.u0[s], self.w0[s],
+                         np.asarray(pertpot, dtype=np.float64))
+        return np.asarray(epot, dtype=np.float64) - ebias
+
+    def compatible(self, states, curr_states):
+        """
+        Returns the len(states) x len(curr_states) boolean mask of the pairs
+        of states that replicas currently in curr_states are allowed to visit.
+        """
+        s = np.asarray(states, dtype=np.intp)
+        c = np.asarray(curr_states, dtype=np.intp)
+        same_direction = self.direction[s][:,None] == self.direction[c][None,:]
+        both_intermediate = (self.intermediate[s] > 0)[:,None] & (self.intermediate[c] > 0)[None,:]
+        return same_direction | both_intermediate
+
+    def reduced_energies(self, states, epot, pertpot):
+        """
+        Returns the len(states) x len(epot) matrix of the reduced energies of
+        the replicas currently in the given states in each of those states.
+        """
+        epot0 = self.unbiased_energies(states, epot, pertpot)
+        s = np.asarray(states, dtype=np.intp)
+        u = self.beta[s][:,None]*(epot0[None,:] + self.bias_energies(states, pertpot))
+        return np.where(self.compatible(states, states), u, LARGE_ENERGY)
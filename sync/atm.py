@@ -1,14 +1,15 @@
 import logging, logging.config
-import math
 import os
 
 from configobj import ConfigObj
 from openmm.unit import kelvin, kilocalories_per_mole
 
-from gibbs_sampling import pairwise_independence_sampling
+from gibbs_sampling import gibbs_exchange
 from ommreplica import OMMReplicaATM
 from ommsystem import OMMSystemAmberRBFE
+from swap_matrix import SwapMatrixATM
 from sync.worker import OMMWorkerATM
+from trajectory_writer import TrajectoryWriter
 from utils.singal_guard import TerminationGuard
 from utils.timer import Timer
 
@@ -30,6 +31,7 @@ class openmm_job_AmberRBFE:
         self.basename = self.config['BASENAME']
         self.state_params = self._getStateParams()
         self.nreplicas = len(self.state_params)
+        self.swap_engine = SwapMatrixATM.from_stateparams(self.state_params)
 
     def _getStateParams(self):
         lambdas = self.config['LAMBDAS'].split(',')
@@ -76,7 +78,7 @@ class openmm_job_AmberRBFE:
                 prmtopfile = self.basename + ".prmtop"
                 crdfile = self.basename + ".inpcrd"
                 ommsystem = OMMSystemAmberRBFE(self.basename, self.config, prmtopfile, crdfile, self.logger)
-                ommsystem.create_system()
+                ommsystem.build_system()
 
             with Timer(self.logger.info, "create worker"):
                 self.worker = OMMWorkerATM(ommsystem, self.config, self.logger)
@@ -89,6 +91,15 @@ class openmm_job_AmberRBFE:
                         replica.set_state(i, self.state_params[i])
                     self.replicas.append(replica)
 
+                atoms = self.config.get('TRJ_ATOMS')
+                if atoms is not None:
+                    atoms = [int(i) for i in atoms]
+                self.trajectory_writer = TrajectoryWriter(ommsystem.topology, ommsystem.MDstepsize,
+                                                          interval=int(self.config['TRJ_FREQUENCY']),
+                                                          atoms=atoms, logger=self.logger)
+                for replica in self.replicas:
+                    replica.open_dcd(self.trajectory_writer)
+
                 self.replica_states = [replica.get_stateid() for replica in self.replicas]
                 for i, replica in enumerate(self.replicas):
                     self.logger.info(f"Replica {i}: cycle {replica.get_cycle()}, state {replica.get_stateid()}")
@@ -133,12 +144,16 @@ class openmm_job_AmberRBFE:
                     with Timer(self.logger.info, "checkpointing"):
                         with TerminationGuard():
                             for replica in self.replicas:
+                                replica.flush_out()
                                 replica.save_checkpoint()
 
                     # Report progress on GPUGRID
                     progress = float(isample)/float(num_samples - last_sample)
                     open("progress", "w").write(str(progress))
 
+            with Timer(self.logger.info, "write remaining trajectory frames"):
+                self.trajectory_writer.close()
+
     def _updateReplicas(self):
         for replica, stateid in zip(self.replicas, self.replica_states):
             replica.set_state(stateid, self.state_params[stateid])
@@ -146,22 +161,18 @@ class openmm_job_AmberRBFE:
     def _exhangeReplicas(self):
 
         # Matrix of replica energies in each state.
-        swap_matrix = self._computeSwapMatrix(range(self.nreplicas), self.replica_states)
+        swap_matrix = self._computeSwapMatrix(list(range(self.nreplicas)), self.replica_states)
         self.logger.debug("Swap matrix")
         for row in swap_matrix:
             self.logger.debug(f"    {row}")
 
         self.logger.debug(f"Replica states before: {self.replica_states}")
-        for repl_i in range(self.nreplicas):
-            sid_i = self.replica_states[repl_i]
-            repl_j = pairwise_independence_sampling(repl_i,sid_i, range(self.nreplicas), self.replica_states, swap_matrix)
-            if repl_j != repl_i:
-                sid_i = self.replica_states[repl_i]
-                sid_j = self.replica_states[repl_j]
-                self.replica_states[repl_i] = sid_j
-                self.replica_states[repl_j] = sid_i
-                self.logger.info(f"Replica {repl_i}: {sid_i} --> {sid_j}")
-                self.logger.info(f"Replica {repl_j}: {sid_j} --> {sid_i}")
+        nsweeps = int(self.config.get('EXCHANGE_SWEEPS', 1))
+        new_states = gibbs_exchange(list(range(self.nreplicas)), self.replica_states, swap_matrix, nsweeps)
+        for repl, (sid_old, sid_new) in enumerate(zip(self.replica_states, new_states)):
+            if sid_new != sid_old:
+                self.logger.info(f"Replica {repl}: {sid_old} --> {sid_new}")
+        self.replica_states = new_states
 
         self.logger.debug(f"Replica states after: {self.replica_states}")
 
@@ -171,73 +182,7 @@ class openmm_job_AmberRBFE:
         and each row is a state so U[i][j] is the energy of replica j in state
         i.
         """
-        U = [[ 0. for _ in range(self.nreplicas)] for _ in range(self.nreplicas)]
-
-        n = len(repls)
-
-        #collect replica parameters and potentials
-        par = [self._getPar(k) for k in repls]
-        pot = [self._getPot(k) for k in repls]
-
-        for i in range(n):
-            repl_i = repls[i]
-            for j in range(n):
-                sid_j = states[j]
-                #energy of replica i in state j
-                U[sid_j][repl_i] = self._reduced_energy(par[j],pot[i])
-        return U
-
-    def _getPar(self, repl):
-        _, par = self.replicas[repl].get_state()
-        return par
-
-    #customized getPot to return the unperturbed potential energy
-    #of the replica U0 = U - W_lambda(u)
-    def _getPot(self, repl):
-        replica = self.replicas[repl]
-        pot = replica.get_energy()
-        epot = pot['potential_energy']
-        pertpot = pot['perturbation_energy']
-        _, par = replica.get_state()
-        lambda1 = par['lambda1']
-        lambda2 = par['lambda2']
-        alpha = par['alpha']
-        u0 = par['u0']
-        w0 = par['w0']
-        ebias = self._softplus(lambda1, lambda2, alpha, u0, w0, pertpot)
-        pot['unbiased_potential_energy'] = epot - ebias
-        pot['direction'] = par['atmdirection']
-        pot['intermediate'] = par['atmintermediate']
-        return pot
-
-    def _reduced_energy(self, par, pot):
-        lambda1 = par['lambda1']
-        lambda2 = par['lambda2']
-        alpha = par['alpha']
-        u0 = par['u0']
-        w0 = par['w0']
-        state_direction = par['atmdirection']
-        state_intermediate = par['atmintermediate']
-        epot0 = pot['unbiased_potential_energy']
-        pertpot = pot['perturbation_energy']
-        replica_direction = pot['direction']
-        replica_intermediate = pot['intermediate']
-
-        kb = 0.0019872041*kilocalories_per_mole/kelvin
-        beta = 1./(kb*par['temperature'])
-
-        if (replica_direction == state_direction) or (state_intermediate > 0 and replica_intermediate > 0):
-            ebias = self._softplus(lambda1, lambda2, alpha, u0, w0, pertpot)
-            return beta*(epot0 + ebias)
-        else:
-            #prevent exchange
-            large_energy = 1.e12
-            return large_energy
-
-    #evaluates the softplus function
-    def _softplus(self, lambda1, lambda2, alpha, u0, w0, uf):
-        ee = 1.0 + math.exp(-alpha*(uf-u0))
-        softplusf = lambda2 * uf + w0
-        if alpha._value > 0.:
-            softplusf += ((lambda2 - lambda1)/alpha) * math.log(ee)
-        return softplusf
+        pots = [self.replicas[k].get_energy() for k in repls]
+        epot = [pot['potential_energy']/kilocalories_per_mole for pot in pots]
+        pertpot = [pot['perturbation_energy']/kilocalories_per_mole for pot in pots]
+        return self.swap_engine.swap_matrix(self.nreplicas, repls, states, epot, pertpot)
@@ -94,6 +94,7 @@ class OMMWorkerATM:
         with Timer(self.logger.debug, "set replica state"):
             _, par = replica.get_state()
             self.set_state(par)
+            self.context.setPeriodicBoxVectors(*replica.boxvectors)
             self.set_posvel(replica.positions, replica.velocities)
 
         with Timer(self.logger.debug, "run replica"):
@@ -114,6 +115,7 @@ class OMMWorkerATM:
             pot = self.get_energy()
 
             replica.set_posvel(pos, vel)
+            replica.set_boxvectors(self.context.getState().getPeriodicBoxVectors())
             replica.set_energy(pot)
             replica.set_cycle(replica.get_cycle() + 1)
             replica.set_mdsteps(replica.get_mdsteps() + nsteps)
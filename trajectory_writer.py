@@ -0,0 +1,89 @@
+"""
+Background writer of replica trajectories for AsyncRE/OpenMM
+"""
+import os
+import threading
+import queue
+import logging
+import numpy as np
+
+from simtk.openmm.app import *
+from simtk.openmm import *
+from simtk.unit import *
+
+def subset_topology(topology, atoms):
+    """
+    Returns a copy of topology holding only the atoms with the given indexes
+    """
+    keep = set(atoms)
+    modeller = Modeller(topology, Quantity(np.zeros((topology.getNumAtoms(),3)), nanometer))
+    modeller.delete([atom for atom in topology.atoms() if atom.index not in keep])
+    return modeller.topology
+
+class TrajectoryWriter(object):
+    """
+    Writes the DCD frames of the replicas in a separate thread fed through a
+    bounded queue, so that the scheduler does not wait on trajectory I/O.
+
+    Only the atoms with indexes in atoms are written, all of them if atoms is
+    None. interval is the number of MD steps between frames, recorded in the
+    DCD headers.
+    """
+    def __init__(self, topology, dt, interval = 1, atoms = None, maxsize = 64, logger = None):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger("async_re.trajectory_writer")
+        if atoms is None:
+            self.atoms = None
+            self.topology = topology
+        else:
+            self.atoms = np.array(sorted(set(atoms)), dtype=np.intp)
+            self.topology = subset_topology(topology, self.atoms)
+        self.dt = dt
+        self.interval = interval
+        self.dcdfiles = {}
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target = self._run, name = "trajectory writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self, key, filename):
+        #registers the trajectory file of a replica, appending to it if it exists
+        append = os.path.isfile(filename)
+        if append:
+            mode = 'r+b'
+        else:
+            mode = 'wb'
+        dcdfile = open(filename, mode)
+        dcd = DCDFile(dcdfile, self.topology, self.dt, interval = self.interval, append = append)
+        dcdfile.flush() # Force the writing of the DCD header
+        self.dcdfiles[key] = (dcdfile, dcd)
+
+    def submit(self, key, positions, boxvectors):
+        #positions is a (natoms,3) array in nm, copied before it is queued
+        if self.atoms is None:
+            positions = np.array(positions)
+        else:
+            positions = positions[self.atoms]
+        self.queue.put((key, positions, boxvectors))
+
+    def close(self):
+        #writes the pending frames and closes the files
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        for (dcdfile, dcd) in self.dcdfiles.values():
+            dcdfile.close()
+        self.dcdfiles = {}
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (key, positions, boxvectors) = item
+            try:
+                (dcdfile, dcd) = self.dcdfiles[key]
+                dcd.writeModel(Quantity(positions, nanometer), periodicBoxVectors = boxvectors)
+            except Exception as e:
+                self.logger.error("unable to write trajectory frame: %s" % e)
@@ -5,8 +5,38 @@ class Transport(object):
     logging.config.fileConfig(os.path.join(os.path.dirname(__file__), "utils/logging.conf"))
 
     def __init__(self):
-        pass
+        #time before which launched runs must complete, None for no limit
+        self.deadline = None
+        #set when no run fits before the deadline
+        self.deadline_blocked = False
 
     def poll(self):
         return
 
+    def cycleDurations(self):
+        #measured wall clock duration (s) of a replica cycle on each device
+        return []
+
+    def predictedReplicaCompletion(self, replica):
+        #predicted time at which a running replica completes, None if unknown
+        return None
+
+    def nodesRunning(self):
+        #number of devices running a replica
+        return 0
+
+    def idleTime(self):
+        #accumulated idle time (s) of the devices
+        return 0.0
+
+    def throughputStatus(self):
+        #text on the throughput of the devices for the status file
+        return ''
+
+    def reprioritizeJob(self, replica, priority):
+        #changes the priority of a replica waiting to be launched
+        return
+
+    def cancelJob(self, replica):
+        #removes a replica waiting to be launched
+        return
@@ -0,0 +1,220 @@
+"""
+UWHAM/MBAR free energy analysis of ATM alchemical replica exchange samples
+
+Replaces uwham_analysis.R. The thermodynamic states are built from the
+TEMPERATURES, LAMBDA1, LAMBDA2, ALPHA, U0, W0COEFF, DIRECTION and
+INTERMEDIATE lists of the control file, in the same order as the job.
+The samples are read from the replica sample logs (see sample_log.py),
+or from the legacy r<k>/<basename>.out files if there are no sample logs.
+
+Usage:
+
+  python uwham_analysis.py <ConfigFile> [discard_low] [discard_high]
+
+Only the samples of each replica from discard_low to discard_high (counting
+from 1) are used. Prints the binding free energy (ABFE) or relative binding
+free energy (RBFE, LIGAND2_ATOMS set) in kcal/mol.
+"""
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import numpy as np
+
+from swap_matrix import SwapMatrixATM
+from sample_log import read_sample_log, sample_log_dir, has_samples, legacy_columns
+
+def uwham(label, logQ, init = None, tol = 1.e-10, maxiter = 100):
+    """
+    Solves the UWHAM (MBAR) equations by Newton's method.
+
+    label[n] is the state (0 to m-1) from which sample n was drawn and
+    logQ[n,j] the negative reduced energy of sample n in state j. init is an
+    optional initial guess of the solution, for example the solution obtained
+    from a subset of the samples.
+
+    Returns (ze, ve) where ze[j] is the log of the normalization constant of
+    state j relative to state 0 and ve[j] is the asymptotic variance of ze[j].
+    States without samples are estimated from the others and given a NaN
+    variance.
+    """
+    logQ = np.asarray(logQ, dtype=np.float64)
+    label = np.asarray(label, dtype=np.intp)
+    (N, m) = logQ.shape
+    counts = np.bincount(label, minlength=m).astype(np.float64)
+    sampled = np.flatnonzero(counts > 0)
+    pi = counts[sampled]/N
+    logpi = np.log(pi)
+    L = logQ[:,sampled]
+
+    z = np.zeros(len(sampled))
+    if init is not None:
+        init = np.asarray(init, dtype=np.float64)[sampled]
+        z = init - init[0]
+
+    #objective function of Tan et al. J. Comput. Graph. Stat. 21, 1 (2012),
+    #its value, the row-normalized weights and the log of the mixture density
+    def objective(z):
+        a = L - z + logpi
+        amax = a.max(axis=1, keepdims=True)
+        w = np.exp(a - amax)
+        s = w.sum(axis=1, keepdims=True)
+        logs = np.log(s) + amax
+        return (np.mean(logs) + np.dot(pi, z), w/s, logs[:,0])
+
+    (f, W, logs) = objective(z)
+    for it in range(maxiter):
+        Wmean = W.mean(axis=0)
+        g = (pi - Wmean)[1:]
+        if np.max(np.abs(g)) < tol:
+            break
+        H = (np.diag(Wmean) - np.dot(W.T, W)/N)[1:,1:]
+        step = np.linalg.solve(H, g)
+        #backtracking line search
+        t = 1.0
+        while True:
+            znew = z.copy()
+            znew[1:] -= t*step
+            (fnew, Wnew, logsnew) = objective(znew)
+            if fnew <= f - 1.e-4*t*np.dot(g, step) or t < 1.e-8:
+                break
+            t *= 0.5
+        (z, f, W, logs) = (znew, fnew, Wnew, logsnew)
+
+    ze = np.empty(m)
+    ze[sampled] = z
+    unsampled = np.flatnonzero(counts == 0)
+    if len(unsampled) > 0:
+        a = logQ[:,unsampled] - logs[:,None]
+        amax = a.max(axis=0)
+        ze[unsampled] = amax + np.log(np.mean(np.exp(a - amax), axis=0))
+    ze = ze - ze[0]
+
+    #asymptotic covariance matrix of Shirts and Chodera, J. Chem. Phys. 129, 124105 (2008),
+    #from the column-normalized weights W/N_k through the eigendecomposition of W^T W
+    Wn = W/counts[sampled]
+    (s2, V) = np.linalg.eigh(np.dot(Wn.T, Wn))
+    S = np.diag(np.sqrt(np.clip(s2, 0., None)))
+    VS = np.dot(V, S)
+    Theta = np.dot(VS, np.dot(np.linalg.pinv(np.eye(len(sampled)) - np.dot(VS.T, np.dot(np.diag(counts[sampled]), VS))), VS.T))
+    ve = np.full(m, np.nan)
+    ve[sampled] = np.clip(np.diag(Theta) + Theta[0,0] - 2.*Theta[0,:], 0., None)
+    return (ze, ve)
+
+def atm_swap_engine(keywords):
+    """
+    Returns the SwapMatrixATM engine of the states of the control file
+    """
+    temperatures = [float(t) for t in keywords.get('TEMPERATURES').split(',')]
+    names = ('LAMBDA1', 'LAMBDA2', 'ALPHA', 'U0', 'W0COEFF', 'DIRECTION', 'INTERMEDIATE')
+    lists = [[float(v) for v in keywords.get(name).split(',')] for name in names]
+    columns = [[] for name in names]
+    temps = []
+    for values in zip(*lists):
+        for tempt in temperatures:
+            temps.append(tempt)
+            for column, value in zip(columns, values):
+                column.append(value)
+    return SwapMatrixATM(temps, *columns)
+
+def atm_legs(swap_engine, ntemperatures):
+    """
+    Returns the alchemical state indexes of the two legs: from the first
+    state to the first intermediate state and from the last state back to the
+    second intermediate state.
+    """
+    intermediate = np.flatnonzero(swap_engine.intermediate[::ntemperatures] > 0)
+    nlambdas = swap_engine.nstates//ntemperatures
+    leg1 = list(range(0, intermediate[0]+1))
+    leg2 = list(range(nlambdas-1, intermediate[-1]-1, -1))
+    return (leg1, leg2)
+
+def load_samples(basename, nreplicas, discard_low = 0, discard_high = None):
+    """
+    Returns the stateid, potE and pertE columns of the samples of the
+    replicas from discard_low to discard_high, counting from 1, and the
+    largest number of samples of a replica.
+    """
+    columns = {'stateid': [], 'potE': [], 'pertE': []}
+    nsamples = 0
+    for replica in range(nreplicas):
+        dirname = sample_log_dir(replica, basename)
+        outfilename = 'r%d/%s.out' % (replica, basename)
+        if has_samples(dirname) or not os.path.isfile(outfilename):
+            data = read_sample_log(dirname)
+        else:
+            table = np.loadtxt(outfilename, ndmin=2)
+            data = {name: table[:,i] for i, name in enumerate(legacy_columns(table.shape[1]))}
+        n = len(data['stateid'])
+        nsamples = max(nsamples, n)
+        low = max(discard_low - 1, 0)
+        high = n if discard_high is None else min(discard_high, n)
+        for name in columns:
+            columns[name].append(np.asarray(data[name][low:high]))
+    samples = {name: np.concatenate(values) for name, values in columns.items()}
+    samples['stateid'] = samples['stateid'].astype(np.intp)
+    return (samples, nsamples)
+
+def leg_free_energy(swap_engine, samples, lambdas, ntemperatures, init = None):
+    """
+    Returns the free energy change (kcal/mol) and its standard error along
+    the given alchemical states, at each temperature, and the UWHAM solution
+    that can be used as the initial guess of a later estimate.
+    """
+    nt = ntemperatures
+    states = np.array([l*nt + t for l in lambdas for t in range(nt)], dtype=np.intp)
+    index = np.full(swap_engine.nstates, -1, dtype=np.intp)
+    index[states] = np.arange(len(states))
+    stateid = samples['stateid']
+    select = index[stateid] >= 0
+    stateid = stateid[select]
+    potE = samples['potE'][select]
+    pertE = samples['pertE'][select]
+
+    e0 = swap_engine.unbiased_energies(stateid, potE, pertE)
+    beta = swap_engine.beta[states]
+    logQ = -(beta[:,None]*(e0[None,:] + swap_engine.bias_energies(states, pertE))).T
+    (ze, ve) = uwham(index[stateid], logQ, init)
+
+    first = np.arange(nt)
+    last = (len(lambdas)-1)*nt + np.arange(nt)
+    dg = -ze[last]/beta[last] + ze[first]/beta[first]
+    ddg = np.sqrt(ve[last] + ve[first])/beta[first]
+    return (dg, ddg, ze)
+
+def binding_free_energy(keywords, samples, init = (None, None)):
+    """
+    Returns the binding free energy (ABFE) or relative binding free energy
+    (RBFE) from both legs, its standard error and the UWHAM solutions of the
+    two legs.
+    """
+    ntemperatures = len(keywords.get('TEMPERATURES').split(','))
+    swap_engine = atm_swap_engine(keywords)
+    (leg1, leg2) = atm_legs(swap_engine, ntemperatures)
+    (dg1, ddg1, ze1) = leg_free_energy(swap_engine, samples, leg1, ntemperatures, init[0])
+    (dg2, ddg2, ze2) = leg_free_energy(swap_engine, samples, leg2, ntemperatures, init[1])
+    if keywords.get('LIGAND2_ATOMS') is not None:
+        dgb = dg1 - dg2
+    else:
+        dgb = dg2 - dg1
+    ddgb = np.sqrt(ddg1*ddg1 + ddg2*ddg2)
+    return (dgb, ddgb, (ze1, ze2))
+
+if __name__ == '__main__':
+    from configobj import ConfigObj
+
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print("usage: python uwham_analysis.py <ConfigFile> [discard_low] [discard_high]")
+        sys.exit(1)
+
+    keywords = ConfigObj(sys.argv[1])
+    discard_low = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    discard_high = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    nstates = len(keywords.get('LAMBDA1').split(','))*len(keywords.get('TEMPERATURES').split(','))
+
+    (samples, nsamples) = load_samples(keywords.get('BASENAME'), nstates, discard_low, discard_high)
+    (dgb, ddgb, ze) = binding_free_energy(keywords, samples)
+    label = "DDGb" if keywords.get('LIGAND2_ATOMS') is not None else "DGb"
+    maxsamples = nsamples if discard_high is None else min(discard_high, nsamples)
+    for (dg, ddg) in zip(dgb, ddgb):
+        print("%s = %f +- %f range %d %d" % (label, dg, ddg, discard_low, maxsamples))